@@ -1,28 +1,182 @@
 # api_key_manager.py
+import os
 import sqlite3
 import logging
 import pathlib
-from datetime import datetime, timedelta
-from threading import RLock
+import time
+from threading import RLock, local
 from typing import Dict, List, Optional, Tuple
 from contextlib import contextmanager
-import json
 
 class NoAvailableKeysError(Exception):
     """当所有API密钥都不可用时抛出此异常"""
     pass
 
+
+# 模块级logger：避免热路径上反复走 logging 模块级函数的根logger查找
+logger = logging.getLogger(__name__)
+
+
+def _now_ts() -> int:
+    """当前时间的整数unix秒：所有时间列统一用整数比较，避免ISO字符串的适配与比较开销"""
+    return int(time.time())
+
+
+# ---------- 热路径SQL：模块级常量，配合连接的语句缓存做到一次解析、反复复用 ----------
+# 窗口计数采用标准滑动窗口近似：当前桶全额计入，上一个桶按其与窗口的剩余
+# 重叠比例加权计入。直接整桶计入会让昨晚用满限额的密钥整个今天都被挡住，
+# 持续吞吐收敛到配置值的一半；只数当前桶则允许跨桶边界的双倍突发。
+_SQL_GET_KEY = '''
+    SELECT
+        k.key,
+        k.key_type,
+        COALESCE(s.consecutive_failures, 0) as consecutive_failures,
+        COALESCE(s.total_requests, 0) as total_count,
+        COALESCE(SUM(CASE WHEN r.bucket_kind = 0 THEN
+            CASE WHEN r.bucket_id = :prev_min THEN r.cnt * :min_frac ELSE r.cnt END
+        END), 0) as minute_requests,
+        COALESCE(SUM(CASE WHEN r.bucket_kind = 1 THEN
+            CASE WHEN r.bucket_id = :prev_day THEN r.cnt * :day_frac ELSE r.cnt END
+        END), 0) as recent_requests
+    FROM api_keys k
+    LEFT JOIN key_stats s ON k.key = s.key
+    LEFT JOIN rate_buckets r ON r.key = k.key
+        AND ((r.bucket_kind = 0 AND r.bucket_id >= :prev_min)
+             OR (r.bucket_kind = 1 AND r.bucket_id >= :prev_day))
+    WHERE k.is_active = 1
+    AND (k.key_type = 'paid' OR :allow_free = 1)
+    AND k.key NOT IN (SELECT key FROM suspended_keys WHERE resume_time > :now_ts)
+    GROUP BY k.key
+    HAVING minute_requests < :rpm AND recent_requests < :rpd
+    ORDER BY CASE WHEN k.key_type = 'free' THEN 0 ELSE 1 END ASC,
+             consecutive_failures ASC, recent_requests ASC, total_count ASC
+    LIMIT 1
+'''
+
+# SQLite 3.35+ 支持 RETURNING：选键与标记使用合并为一条语句
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+_SQL_PICK_AND_MARK = '''
+    UPDATE key_stats
+    SET total_requests = total_requests + 1,
+        last_used = :now_ts
+    WHERE key = (
+        SELECT k.key
+        FROM api_keys k
+        LEFT JOIN key_stats s ON k.key = s.key
+        LEFT JOIN rate_buckets r ON r.key = k.key
+            AND ((r.bucket_kind = 0 AND r.bucket_id >= :prev_min)
+                 OR (r.bucket_kind = 1 AND r.bucket_id >= :prev_day))
+        WHERE k.is_active = 1
+        AND (k.key_type = 'paid' OR :allow_free = 1)
+        AND k.key NOT IN (SELECT key FROM suspended_keys WHERE resume_time > :now_ts)
+        GROUP BY k.key
+        HAVING COALESCE(SUM(CASE WHEN r.bucket_kind = 0 THEN
+                   CASE WHEN r.bucket_id = :prev_min THEN r.cnt * :min_frac ELSE r.cnt END
+               END), 0) < :rpm
+           AND COALESCE(SUM(CASE WHEN r.bucket_kind = 1 THEN
+                   CASE WHEN r.bucket_id = :prev_day THEN r.cnt * :day_frac ELSE r.cnt END
+               END), 0) < :rpd
+        ORDER BY CASE WHEN k.key_type = 'free' THEN 0 ELSE 1 END ASC,
+                 COALESCE(s.consecutive_failures, 0) ASC,
+                 COALESCE(SUM(CASE WHEN r.bucket_kind = 1 THEN
+                     CASE WHEN r.bucket_id = :prev_day THEN r.cnt * :day_frac ELSE r.cnt END
+                 END), 0) ASC,
+                 COALESCE(s.total_requests, 0) ASC
+        LIMIT 1
+    )
+    RETURNING key
+'''
+
+_SQL_RATE_CHECK = '''
+    SELECT
+        COALESCE(SUM(CASE WHEN bucket_kind = 0 AND bucket_id >= :prev_min THEN
+            CASE WHEN bucket_id = :prev_min THEN cnt * :min_frac ELSE cnt END
+        END), 0) as minute_count,
+        COALESCE(SUM(CASE WHEN bucket_kind = 1 AND bucket_id >= :prev_day THEN
+            CASE WHEN bucket_id = :prev_day THEN cnt * :day_frac ELSE cnt END
+        END), 0) as day_count
+    FROM rate_buckets WHERE key = :key
+'''
+
+
+def _window_params(now_ts: int) -> Dict[str, float]:
+    """滑动窗口的公共参数：上一个桶的id与其落在窗口内的剩余比例"""
+    return {
+        'prev_min': now_ts // 60 - 1,
+        'min_frac': (60 - now_ts % 60) / 60,
+        'prev_day': now_ts // 86400 - 1,
+        'day_frac': (86400 - now_ts % 86400) / 86400,
+    }
+
+_SQL_MARK_USED = '''
+    UPDATE key_stats
+    SET total_requests = total_requests + 1,
+        last_used = ?
+    WHERE key = ?
+'''
+
+_SQL_BUCKET_UPSERT = '''
+    INSERT INTO rate_buckets (key, bucket_kind, bucket_id, cnt)
+    VALUES (?, ?, ?, 1)
+    ON CONFLICT(key, bucket_kind, bucket_id) DO UPDATE SET cnt = cnt + 1
+'''
+
+_SQL_SUCCESS_STATS = '''
+    UPDATE key_stats
+    SET successful_requests = successful_requests + 1,
+        consecutive_failures = 0,
+        last_success = ?
+    WHERE key = ?
+'''
+
+# 状态汇总：用 UNION ALL 打标签，把原来的多次查询合并为一次往返
+_SQL_STATUS = '''
+    WITH susp AS (
+        SELECT key FROM suspended_keys WHERE resume_time > ?
+    )
+    SELECT 'types' AS metric, key_type AS name,
+           COUNT(*) AS v1,
+           COUNT(CASE WHEN key NOT IN (SELECT key FROM susp) THEN 1 END) AS v2
+    FROM api_keys
+    WHERE is_active = 1
+    GROUP BY key_type
+    UNION ALL
+    SELECT 'requests', k.key_type,
+           SUM(s.successful_requests),
+           SUM(s.failed_requests)
+    FROM key_stats s
+    JOIN api_keys k ON s.key = k.key
+    WHERE k.is_active = 1
+    GROUP BY k.key_type
+    UNION ALL
+    SELECT 'errors', code,
+           SUM(count),
+           NULL
+    FROM key_errors
+    GROUP BY code
+'''
+
+_SQL_ERROR_UPSERT = '''
+    INSERT INTO key_errors (key, code, count)
+    VALUES (?, ?, 1)
+    ON CONFLICT(key, code) DO UPDATE SET count = count + 1
+'''
+
 class APIKeyManager:
     """使用SQLite的线程安全API密钥管理器"""
 
+    # 记录已启用 WAL 的数据库路径（journal_mode 持久化在库文件中，设置一次即可）
+    _wal_enabled_paths = set()
+
     def __init__(self, free_key_path: pathlib.Path, paid_key_path: pathlib.Path,
                  db_path: pathlib.Path, config: dict = None):
         # 检查密钥文件是否存在
         if not free_key_path.exists():
-            logging.warning(f"免费密钥文件不存在: {free_key_path}，将创建空文件")
+            logger.warning(f"免费密钥文件不存在: {free_key_path}，将创建空文件")
             free_key_path.touch()
         if not paid_key_path.exists():
-            logging.warning(f"付费密钥文件不存在: {paid_key_path}，将创建空文件")
+            logger.warning(f"付费密钥文件不存在: {paid_key_path}，将创建空文件")
             paid_key_path.touch()
 
         self.free_key_path = free_key_path
@@ -31,6 +185,14 @@ class APIKeyManager:
         self.config = config or {}
         self.lock = RLock()
 
+        # 常驻写连接：所有写操作在 self.lock 下串行化，复用同一连接避免反复 connect
+        self._writer_conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                            cached_statements=256)
+        self._writer_conn.row_factory = sqlite3.Row
+        self._apply_pragmas(self._writer_conn)
+        # 读连接按线程缓存，每个线程复用自己的连接（及其页缓存）
+        self._local = local()
+
         # 加载配置
         self.cooldown_seconds = self.config.get('cooldown_seconds', 300)
         self.requests_per_minute = self.config.get('requests_per_minute', 5)
@@ -40,11 +202,31 @@ class APIKeyManager:
         # 用于记录免费密钥连续失败次数
         self.free_key_consecutive_failures = 0
 
+        # 秒级 TTL 缓存：挂起状态与活跃密钥总数变化频率低，避免热路径反复查库
+        self._cache_ttl = 1.0
+        self._suspended_cache: Dict[str, int] = {}
+        self._suspended_cache_ts = 0.0
+        self._total_keys_cache = 0
+        self._total_keys_cache_ts = 0.0
+
+        # 过期数据清理的节流时间戳：热路径上最多每60秒清理一次
+        self._cleanup_interval = 60.0
+        self._last_cleanup = 0.0
+
+        # 密钥文件的 mtime 缓存：文件未变化时跳过重新读取
+        self._key_file_cache: Dict[pathlib.Path, Tuple[float, List[str]]] = {}
+
+        # 成功记录的写缓冲：攒批后单事务落库，减少 fsync 次数
+        self._pending_success: List[Tuple[str, int]] = []
+        self._pending_flush_size = 50
+        self._pending_flush_interval = 0.2
+        self._last_success_flush = time.monotonic()
+
         # 初始化数据库
         self._init_database()
 
         # 从数据库加载免费密钥连续失败计数
-        with self._get_db_connection() as conn:
+        with self._reader() as conn:
             result = conn.execute(
                 "SELECT value FROM global_state WHERE key = 'free_key_consecutive_failures'"
             ).fetchone()
@@ -56,52 +238,104 @@ class APIKeyManager:
         # 清理过期数据
         self._cleanup_expired_data()
 
-        logging.info(f"APIKeyManager 初始化完成: {self._get_total_keys()} 个密钥")
+        logger.info(f"APIKeyManager 初始化完成: {self._get_total_keys()} 个密钥")
+
+    def _apply_pragmas(self, conn: sqlite3.Connection):
+        """为新连接设置性能相关的PRAGMA"""
+        # WAL 模式写入磁盘一次后即持久化，无需每个连接重复切换
+        if str(self.db_path) not in APIKeyManager._wal_enabled_paths:
+            conn.execute("PRAGMA journal_mode=WAL")
+            APIKeyManager._wal_enabled_paths.add(str(self.db_path))
+        # 以下为连接级设置：降低fsync频率、内存临时表、增大页缓存与mmap、写冲突等待
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA mmap_size=30000000000")
+        conn.execute("PRAGMA busy_timeout=5000")
 
     @contextmanager
-    def _get_db_connection(self):
-        """获取数据库连接的上下文管理器"""
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        try:
-            yield conn
-        finally:
+    def _writer(self):
+        """获取常驻写连接（调用方需持有 self.lock 串行化写入）"""
+        yield self._writer_conn
+
+    @contextmanager
+    def _reader(self):
+        """获取当前线程的只读连接，不存在则创建并缓存"""
+        conn = getattr(self._local, 'reader_conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            self._apply_pragmas(conn)
+            conn.execute("PRAGMA query_only=1")
+            self._local.reader_conn = conn
+        yield conn
+
+    def close(self):
+        """关闭常驻连接（仅在管理器停用时调用）"""
+        with self.lock:
+            self._flush_pending_success()
+        self._writer_conn.close()
+        conn = getattr(self._local, 'reader_conn', None)
+        if conn is not None:
             conn.close()
+            self._local.reader_conn = None
+
+    @staticmethod
+    def _migrate_to_without_rowid(conn: sqlite3.Connection, table: str, create_sql: str):
+        """将旧版本的 rowid 表迁移为 WITHOUT ROWID（文本主键表存储减半、查找更快）"""
+        row = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table,)
+        ).fetchone()
+        if row and 'WITHOUT ROWID' not in (row['sql'] or ''):
+            # 经 ALTER TABLE 补过列的旧库里列的物理顺序与新建表不同（补的列在末尾），
+            # 必须按列名搬运，SELECT * 会把数据错位写进新表
+            columns = [c[1] for c in conn.execute(f"PRAGMA table_info({table})")]
+            col_list = ', '.join(columns)
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            conn.execute(create_sql)
+            conn.execute(
+                f"INSERT INTO {table} ({col_list}) SELECT {col_list} FROM {table}_old"
+            )
+            conn.execute(f"DROP TABLE {table}_old")
 
     def _init_database(self):
         """初始化数据库表"""
-        with self._get_db_connection() as conn:
-            # 更新api_keys表，添加key_type字段
-            conn.execute('''
+        # 文本主键表统一使用 WITHOUT ROWID，避免 rowid 与主键双重存储
+        api_keys_sql = '''
                 CREATE TABLE IF NOT EXISTS api_keys (
                     key TEXT PRIMARY KEY,
                     key_type TEXT DEFAULT 'free',
                     is_active INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # 检查是否需要添加key_type列（用于升级旧版本数据库）
-            cursor = conn.execute("PRAGMA table_info(api_keys)")
-            columns = [column[1] for column in cursor.fetchall()]
-            if 'key_type' not in columns:
-                conn.execute("ALTER TABLE api_keys ADD COLUMN key_type TEXT DEFAULT 'free'")
-
-            conn.execute('''
+                    created_at INTEGER DEFAULT (strftime('%s', 'now'))
+                ) WITHOUT ROWID
+        '''
+        key_stats_sql = '''
                 CREATE TABLE IF NOT EXISTS key_stats (
                     key TEXT PRIMARY KEY,
                     total_requests INTEGER DEFAULT 0,
                     successful_requests INTEGER DEFAULT 0,
                     failed_requests INTEGER DEFAULT 0,
                     consecutive_failures INTEGER DEFAULT 0,
-                    last_used TIMESTAMP,
-                    last_success TIMESTAMP,
+                    last_used INTEGER,
+                    last_success INTEGER,
                     last_error_code INTEGER,
-                    last_error_time TIMESTAMP,
+                    last_error_time INTEGER,
                     error_counts TEXT DEFAULT '{}',
                     FOREIGN KEY (key) REFERENCES api_keys(key)
-                )
-            ''')
+                ) WITHOUT ROWID
+        '''
+        with self._writer() as conn:
+            # 更新api_keys表，添加key_type字段
+            conn.execute(api_keys_sql)
+
+            # 检查是否需要添加key_type列（用于升级旧版本数据库）
+            cursor = conn.execute("PRAGMA table_info(api_keys)")
+            columns = [column[1] for column in cursor.fetchall()]
+            if 'key_type' not in columns:
+                conn.execute("ALTER TABLE api_keys ADD COLUMN key_type TEXT DEFAULT 'free'")
+
+            conn.execute(key_stats_sql)
 
             # 检查是否需要添加consecutive_failures列
             cursor = conn.execute("PRAGMA table_info(key_stats)")
@@ -109,27 +343,54 @@ class APIKeyManager:
             if 'consecutive_failures' not in columns:
                 conn.execute("ALTER TABLE key_stats ADD COLUMN consecutive_failures INTEGER DEFAULT 0")
 
+            # 预聚合的滑动窗口计数桶，替代逐行记录的 rate_limits 表：
+            # bucket_kind 0 = 分钟桶（bucket_id = epoch秒/60），1 = 日桶（epoch秒/86400）
             conn.execute('''
-                CREATE TABLE IF NOT EXISTS rate_limits (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                CREATE TABLE IF NOT EXISTS rate_buckets (
                     key TEXT,
-                    request_time TIMESTAMP,
-                    FOREIGN KEY (key) REFERENCES api_keys(key)
-                )
+                    bucket_kind INTEGER,
+                    bucket_id INTEGER,
+                    cnt INTEGER DEFAULT 0,
+                    PRIMARY KEY (key, bucket_kind, bucket_id)
+                ) WITHOUT ROWID
             ''')
 
-            conn.execute('''
-                CREATE INDEX IF NOT EXISTS idx_rate_limits_key_time
-                ON rate_limits(key, request_time)
-            ''')
+            # 移除旧版本的逐行速率记录表（数据为24小时内的临时数据，可安全丢弃）
+            conn.execute("DROP INDEX IF EXISTS idx_rate_limits_key_time")
+            conn.execute("DROP TABLE IF EXISTS rate_limits")
 
-            conn.execute('''
+            suspended_keys_sql = '''
                 CREATE TABLE IF NOT EXISTS suspended_keys (
                     key TEXT PRIMARY KEY,
-                    resume_time TIMESTAMP,
+                    resume_time INTEGER,
                     reason TEXT,
                     FOREIGN KEY (key) REFERENCES api_keys(key)
-                )
+                ) WITHOUT ROWID
+            '''
+            conn.execute(suspended_keys_sql)
+
+            # resume_time 上的索引：加速过期清理的 DELETE 与 get_key 中的 NOT IN 子查询
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_suspended_resume
+                ON suspended_keys(resume_time)
+            ''')
+
+            # get_key 热查询的覆盖索引：(is_active, key_type, key) 可走 index-only 扫描，
+            # 不必回表过滤非活跃行；get_status 的分类聚合同样受益
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_api_keys_active_type
+                ON api_keys(is_active, key_type, key)
+            ''')
+
+            # 规范化的错误计数表，替代 key_stats.error_counts 的JSON文本：
+            # 按 (key, code) 原地UPDATE累加，统计时直接 GROUP BY
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS key_errors (
+                    key TEXT,
+                    code TEXT,
+                    count INTEGER DEFAULT 0,
+                    PRIMARY KEY (key, code)
+                ) WITHOUT ROWID
             ''')
 
             # 添加一个新表来存储全局状态
@@ -146,132 +407,220 @@ class APIKeyManager:
                 VALUES ('free_key_consecutive_failures', '0')
             ''')
 
+            # 旧版本数据库为 rowid 表，按需原地迁移
+            self._migrate_to_without_rowid(conn, 'api_keys', api_keys_sql)
+            self._migrate_to_without_rowid(conn, 'key_stats', key_stats_sql)
+            self._migrate_to_without_rowid(conn, 'suspended_keys', suspended_keys_sql)
+
+            # 旧版本以ISO字符串存时间，一次性转换为整数unix秒
+            migrated = conn.execute(
+                "SELECT 1 FROM global_state WHERE key = 'ts_epoch_migrated'"
+            ).fetchone()
+            if not migrated:
+                for table, cols in (('api_keys', ['created_at']),
+                                    ('key_stats', ['last_used', 'last_success', 'last_error_time']),
+                                    ('suspended_keys', ['resume_time'])):
+                    for col in cols:
+                        conn.execute(
+                            f'''UPDATE {table}
+                                SET {col} = CAST(strftime('%s', {col}) AS INTEGER)
+                                WHERE {col} IS NOT NULL AND typeof({col}) = 'text' '''
+                        )
+                conn.execute(
+                    "INSERT OR IGNORE INTO global_state (key, value) VALUES ('ts_epoch_migrated', '1')"
+                )
+
+            # 把旧的 error_counts JSON 一次性展开进 key_errors 表
+            migrated = conn.execute(
+                "SELECT 1 FROM global_state WHERE key = 'key_errors_migrated'"
+            ).fetchone()
+            if not migrated:
+                conn.execute('''
+                    INSERT INTO key_errors (key, code, count)
+                    SELECT key_stats.key, je.key, CAST(je.value AS INTEGER)
+                    FROM key_stats, json_each(key_stats.error_counts) je
+                    WHERE error_counts != '{}'
+                    ON CONFLICT(key, code) DO UPDATE SET count = count + excluded.count
+                ''')
+                conn.execute("UPDATE key_stats SET error_counts = '{}' WHERE error_counts != '{}'")
+                conn.execute(
+                    "INSERT OR IGNORE INTO global_state (key, value) VALUES ('key_errors_migrated', '1')"
+                )
+
             conn.commit()
 
 
+    def _read_key_file(self, path: pathlib.Path) -> List[str]:
+        """读取密钥文件：mtime 未变化时直接返回缓存，读取时一次性读入全文"""
+        mtime = path.stat().st_mtime
+        cached = self._key_file_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        keys = [line.strip() for line in path.read_text(encoding='utf-8').splitlines()
+                if line.strip()]
+        self._key_file_cache[path] = (mtime, keys)
+        return keys
+
+    def _write_key_file(self, path: pathlib.Path, keys: List[str]):
+        """写密钥文件：先写同目录临时文件再原子替换，避免崩溃留下半截文件"""
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(''.join(f"{key}\n" for key in keys), encoding='utf-8')
+        os.replace(tmp_path, path)
+        self._key_file_cache[path] = (path.stat().st_mtime, list(keys))
+
     def _sync_keys_with_files(self):
         """同步文件中的密钥到数据库"""
-        # 读取免费密钥
-        with open(self.free_key_path, 'r', encoding='utf-8') as f:
-            free_keys = set(line.strip() for line in f if line.strip())
-
-        # 读取付费密钥
-        with open(self.paid_key_path, 'r', encoding='utf-8') as f:
-            paid_keys = set(line.strip() for line in f if line.strip())
+        # 读取免费/付费密钥（mtime 未变化时命中缓存）
+        free_keys = set(self._read_key_file(self.free_key_path))
+        paid_keys = set(self._read_key_file(self.paid_key_path))
 
         # 检查是否有重复的密钥
         duplicate_keys = free_keys & paid_keys
         if duplicate_keys:
-            logging.warning(f"发现 {len(duplicate_keys)} 个重复密钥，将从免费密钥中移除")
+            logger.warning(f"发现 {len(duplicate_keys)} 个重复密钥，将从免费密钥中移除")
             free_keys -= duplicate_keys
             # 更新免费密钥文件
-            with open(self.free_key_path, 'w', encoding='utf-8') as f:
-                for key in free_keys:
-                    f.write(f"{key}\n")
+            self._write_key_file(self.free_key_path, sorted(free_keys))
+
+        with self._writer() as conn:
+            # 整个同步放在一个立即事务中，所有批量语句共享一次提交
+            conn.execute("BEGIN IMMEDIATE")
 
-        with self._get_db_connection() as conn:
             # 获取数据库中的所有活跃密钥
             db_keys = {}
             for row in conn.execute("SELECT key, key_type FROM api_keys WHERE is_active = 1"):
                 db_keys[row['key']] = row['key_type']
 
-            # 处理免费密钥
+            # 批量写入新密钥
             new_free_keys = free_keys - set(db_keys.keys())
-            for key in new_free_keys:
-                conn.execute("INSERT OR IGNORE INTO api_keys (key, key_type) VALUES (?, ?)",
-                           (key, 'free'))
-                conn.execute("INSERT OR IGNORE INTO key_stats (key) VALUES (?)", (key,))
-
-            # 处理付费密钥
             new_paid_keys = paid_keys - set(db_keys.keys())
-            for key in new_paid_keys:
-                conn.execute("INSERT OR IGNORE INTO api_keys (key, key_type) VALUES (?, ?)",
-                           (key, 'paid'))
-                conn.execute("INSERT OR IGNORE INTO key_stats (key) VALUES (?)", (key,))
-
-            # 更新已存在密钥的类型
-            for key in free_keys:
-                if key in db_keys and db_keys[key] != 'free':
-                    conn.execute("UPDATE api_keys SET key_type = 'free' WHERE key = ?", (key,))
-
-            for key in paid_keys:
-                if key in db_keys and db_keys[key] != 'paid':
-                    conn.execute("UPDATE api_keys SET key_type = 'paid' WHERE key = ?", (key,))
-
-            # 标记已删除的密钥为非活跃
-            all_file_keys = free_keys | paid_keys
-            deleted_keys = set(db_keys.keys()) - all_file_keys
-            for key in deleted_keys:
-                conn.execute("UPDATE api_keys SET is_active = 0 WHERE key = ?", (key,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO api_keys (key, key_type) VALUES (?, ?)",
+                [(key, 'free') for key in new_free_keys]
+                + [(key, 'paid') for key in new_paid_keys]
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO key_stats (key) VALUES (?)",
+                [(key,) for key in new_free_keys | new_paid_keys]
+            )
+
+            # 批量更新已存在密钥的类型
+            conn.executemany(
+                "UPDATE api_keys SET key_type = 'free' WHERE key = ?",
+                [(key,) for key in free_keys if db_keys.get(key, 'free') != 'free']
+            )
+            conn.executemany(
+                "UPDATE api_keys SET key_type = 'paid' WHERE key = ?",
+                [(key,) for key in paid_keys if db_keys.get(key, 'paid') != 'paid']
+            )
+
+            # 批量标记已删除的密钥为非活跃
+            deleted_keys = set(db_keys.keys()) - (free_keys | paid_keys)
+            conn.executemany(
+                "UPDATE api_keys SET is_active = 0 WHERE key = ?",
+                [(key,) for key in deleted_keys]
+            )
 
             conn.commit()
 
+            # 密钥集合变化后刷新统计信息，帮助查询规划器选中覆盖索引
+            if new_free_keys or new_paid_keys or deleted_keys:
+                conn.execute("ANALYZE")
+
             if new_free_keys:
-                logging.info(f"添加了 {len(new_free_keys)} 个新的免费密钥")
+                logger.info(f"添加了 {len(new_free_keys)} 个新的免费密钥")
             if new_paid_keys:
-                logging.info(f"添加了 {len(new_paid_keys)} 个新的付费密钥")
+                logger.info(f"添加了 {len(new_paid_keys)} 个新的付费密钥")
             if deleted_keys:
-                logging.info(f"标记了 {len(deleted_keys)} 个密钥为非活跃")
+                logger.info(f"标记了 {len(deleted_keys)} 个密钥为非活跃")
+
+    def _maybe_cleanup_expired_data(self):
+        """按节流间隔清理过期数据，避免在热路径上每次调用都执行 DELETE"""
+        now = time.monotonic()
+        if now - self._last_cleanup < self._cleanup_interval:
+            return
+        self._last_cleanup = now
+        self._cleanup_expired_data()
 
     def _cleanup_expired_data(self):
         """清理过期的数据"""
-        with self._get_db_connection() as conn:
+        with self._writer() as conn:
             # 清理过期的挂起状态
+            now_ts = _now_ts()
             conn.execute(
                 "DELETE FROM suspended_keys WHERE resume_time <= ?",
-                (datetime.now(),)
+                (now_ts,)
             )
 
-            # 清理超过24小时的速率限制记录
-            cutoff_time = datetime.now() - timedelta(hours=24)
+            # 清理滑出窗口的计数桶（分钟桶保留2分钟，日桶保留2天）
+            conn.execute(
+                "DELETE FROM rate_buckets WHERE bucket_kind = 0 AND bucket_id <= ?",
+                ((now_ts - 120) // 60,)
+            )
             conn.execute(
-                "DELETE FROM rate_limits WHERE request_time < ?",
-                (cutoff_time,)
+                "DELETE FROM rate_buckets WHERE bucket_kind = 1 AND bucket_id <= ?",
+                ((now_ts - 2 * 86400) // 86400,)
             )
 
             conn.commit()
 
     def _get_total_keys(self) -> int:
-        """获取活跃密钥总数"""
-        with self._get_db_connection() as conn:
-            result = conn.execute("SELECT COUNT(*) FROM api_keys WHERE is_active = 1").fetchone()
-            return result[0]
-
-    def _check_rate_limit(self, key: str) -> Tuple[bool, Optional[str]]:
-        """检查密钥是否超过速率限制"""
-        with self._get_db_connection() as conn:
-            now = datetime.now()
-
-            # 检查分钟级限制
-            minute_ago = now - timedelta(minutes=1)
-            minute_count = conn.execute(
-                "SELECT COUNT(*) FROM rate_limits WHERE key = ? AND request_time > ?",
-                (key, minute_ago)
-            ).fetchone()[0]
-
-            if minute_count >= self.requests_per_minute:
-                return False, f"已达到每分钟限制 ({self.requests_per_minute}次/分钟)"
-
-            # 检查日级限制
-            day_ago = now - timedelta(days=1)
-            day_count = conn.execute(
-                "SELECT COUNT(*) FROM rate_limits WHERE key = ? AND request_time > ?",
-                (key, day_ago)
-            ).fetchone()[0]
-
-            if day_count >= self.requests_per_day:
-                return False, f"已达到每日限制 ({self.requests_per_day}次/天)"
-
-            return True, None
+        """获取活跃密钥总数（带秒级TTL缓存）"""
+        now = time.monotonic()
+        if now - self._total_keys_cache_ts > self._cache_ttl:
+            with self._reader() as conn:
+                result = conn.execute("SELECT COUNT(*) FROM api_keys WHERE is_active = 1").fetchone()
+                self._total_keys_cache = result[0]
+                self._total_keys_cache_ts = now
+        return self._total_keys_cache
+
+    def _check_rate_limit(self, key: str,
+                          conn: Optional[sqlite3.Connection] = None) -> Tuple[bool, Optional[str]]:
+        """检查密钥是否超过速率限制（可复用调用方已持有的连接）"""
+        if conn is None:
+            with self._reader() as reader_conn:
+                return self._check_rate_limit(key, reader_conn)
+
+        # 一次主键范围扫描同时得到分钟级与日级的加权窗口计数
+        params = _window_params(_now_ts())
+        params['key'] = key
+        row = conn.execute(_SQL_RATE_CHECK, params).fetchone()
+
+        # 合并尚未落库的缓冲计数
+        pending = sum(1 for k, _ in self._pending_success if k == key)
+
+        if (row['minute_count'] or 0) + pending >= self.requests_per_minute:
+            return False, f"已达到每分钟限制 ({self.requests_per_minute}次/分钟)"
+
+        if row['day_count'] + pending >= self.requests_per_day:
+            return False, f"已达到每日限制 ({self.requests_per_day}次/天)"
+
+        return True, None
+
+    def _refresh_suspended_cache(self):
+        """按TTL刷新挂起密钥缓存（key → 恢复时间）"""
+        now = time.monotonic()
+        if now - self._suspended_cache_ts > self._cache_ttl:
+            with self._reader() as conn:
+                cache = {}
+                for row in conn.execute("SELECT key, resume_time FROM suspended_keys"):
+                    try:
+                        cache[row['key']] = int(row['resume_time'])
+                    except (TypeError, ValueError):
+                        continue
+                self._suspended_cache = cache
+                self._suspended_cache_ts = now
+
+    def _invalidate_caches(self):
+        """挂起/移除密钥后使TTL缓存失效，下次访问时重新加载"""
+        self._suspended_cache_ts = 0.0
+        self._total_keys_cache_ts = 0.0
 
     def _is_key_suspended(self, key: str) -> bool:
-        """检查密钥是否被挂起"""
-        with self._get_db_connection() as conn:
-            result = conn.execute(
-                "SELECT resume_time FROM suspended_keys WHERE key = ? AND resume_time > ?",
-                (key, datetime.now())
-            ).fetchone()
-            return result is not None
+        """检查密钥是否被挂起（走TTL缓存的字典查找）"""
+        self._refresh_suspended_cache()
+        resume_time = self._suspended_cache.get(key)
+        return resume_time is not None and resume_time > _now_ts()
 
     def get_key(self, preferred_key: Optional[str] = None, force_paid: bool = False) -> str:
         """
@@ -285,15 +634,16 @@ class APIKeyManager:
             可用的API密钥
         """
         with self.lock:
-            # 清理过期数据
-            self._cleanup_expired_data()
+            # 先将缓冲的成功记录落库，保证选键查询看到最新计数
+            self._flush_pending_success()
 
-            # 从数据库重新加载当前的失败计数，确保使用最新值
-            with self._get_db_connection() as conn:
-                result = conn.execute(
-                    "SELECT value FROM global_state WHERE key = 'free_key_consecutive_failures'"
-                ).fetchone()
-                self.free_key_consecutive_failures = int(result['value']) if result else 0
+            # 清理过期数据（节流，通常直接跳过）
+            self._maybe_cleanup_expired_data()
+
+            # 所有对失败计数的修改都在 self.lock 下进行，
+            # 内存中的 free_key_consecutive_failures 即为权威值（初始化时已从库加载），
+            # 无需每次选键都回读 global_state
+            with self._writer() as conn:
 
                 # 检查是否应该使用付费密钥
                 use_paid = force_paid or self.free_key_consecutive_failures >= self.max_free_key_failures
@@ -304,51 +654,47 @@ class APIKeyManager:
                         self._mark_key_used(preferred_key, conn)
                         return preferred_key
 
-                # 构建查询条件
-                key_type_condition = "= 'paid'" if use_paid else "= 'free'"
                 if use_paid and self.free_key_consecutive_failures >= self.max_free_key_failures:
-                    logging.info(f"免费密钥连续失败 {self.free_key_consecutive_failures} 次，切换到付费密钥")
-
-                # 获取指定类型的可用密钥
-                query = '''
-                    SELECT
-                        k.key,
-                        k.key_type,
-                        COALESCE(s.successful_requests, 0) as success_count,
-                        COALESCE(s.failed_requests, 0) as fail_count,
-                        COALESCE(s.total_requests, 0) as total_count,
-                        COALESCE(s.consecutive_failures, 0) as consecutive_failures,
-                        (SELECT COUNT(*) FROM rate_limits r
-                         WHERE r.key = k.key AND r.request_time > ?) as recent_requests
-                    FROM api_keys k
-                    LEFT JOIN key_stats s ON k.key = s.key
-                    WHERE k.is_active = 1
-                    AND k.key_type {}
-                    AND k.key NOT IN (SELECT key FROM suspended_keys WHERE resume_time > ?)
-                    ORDER BY consecutive_failures ASC, recent_requests ASC, total_count ASC
-                '''.format(key_type_condition)
-
-                day_ago = datetime.now() - timedelta(days=1)
-                rows = conn.execute(query, (day_ago, datetime.now())).fetchall()
-
-                # 找到第一个未超过速率限制的密钥
-                for row in rows:
-                    key = row['key']
-                    if key == preferred_key:
-                        continue
-
-                    allowed, _ = self._check_rate_limit(key)
-                    if allowed:
+                    logger.info(f"免费密钥连续失败 {self.free_key_consecutive_failures} 次，切换到付费密钥")
+
+                # 单条查询覆盖降级路径：免费与付费候选按优先级排序（免费在前），
+                # 免费密钥全部不可用时同一结果集直接落到最优付费密钥，
+                # 不再递归重入 get_key；速率限制仍在 SQL 中过滤
+                allow_free = 0 if use_paid else 1
+                now_ts = _now_ts()
+                window_args = _window_params(now_ts)
+                window_args.update(allow_free=allow_free, now_ts=now_ts,
+                                   rpm=self.requests_per_minute,
+                                   rpd=self.requests_per_day)
+
+                if _HAS_RETURNING:
+                    # 选键 + 标记使用合并为一条 UPDATE ... RETURNING
+                    row = conn.execute(_SQL_PICK_AND_MARK, window_args).fetchone()
+                    if row:
+                        conn.commit()
+                        key = row['key']
+                        if allow_free:
+                            self._warn_if_paid_fallback(key, conn)
+                        return key
+                else:
+                    row = conn.execute(_SQL_GET_KEY, window_args).fetchone()
+                    if row:
+                        key = row['key']
                         self._mark_key_used(key, conn)
+                        if allow_free and row['key_type'] == 'paid':
+                            logger.warning("所有免费密钥都不可用，已回退到付费密钥")
                         return key
 
-                # 如果免费密钥不可用，尝试付费密钥
-                if not use_paid:
-                    logging.warning("所有免费密钥都不可用，尝试使用付费密钥")
-                    return self.get_key(preferred_key=preferred_key, force_paid=True)
-
                 raise NoAvailableKeysError("所有密钥都不可用（速率限制或挂起中）")
 
+    def _warn_if_paid_fallback(self, key: str, conn: sqlite3.Connection):
+        """RETURNING 路径拿不到 key_type（RETURNING 不允许子查询），补一次主键点查用于降级日志"""
+        row = conn.execute(
+            "SELECT key_type FROM api_keys WHERE key = ?", (key,)
+        ).fetchone()
+        if row and row['key_type'] == 'paid':
+            logger.warning("所有免费密钥都不可用，已回退到付费密钥")
+
     def _is_key_available(self, key: str, conn: sqlite3.Connection) -> bool:
         """检查密钥是否可用"""
         # 检查是否为活跃密钥
@@ -363,126 +709,113 @@ class APIKeyManager:
         if self._is_key_suspended(key):
             return False
 
-        # 检查速率限制
-        allowed, _ = self._check_rate_limit(key)
+        # 检查速率限制（复用同一连接）
+        allowed, _ = self._check_rate_limit(key, conn)
         return allowed
 
     def _mark_key_used(self, key: str, conn: sqlite3.Connection):
         """标记密钥被使用"""
-        conn.execute(
-            '''UPDATE key_stats
-               SET total_requests = total_requests + 1,
-                   last_used = ?
-               WHERE key = ?''',
-            (datetime.now(), key)
-        )
+        conn.execute(_SQL_MARK_USED, (_now_ts(), key))
         conn.commit()
 
     def record_success(self, key: str):
-        """记录成功的API调用"""
+        """记录成功的API调用（写入内存缓冲，按批落库）"""
         with self.lock:
-            with self._get_db_connection() as conn:
-                # 记录到速率限制表
-                conn.execute(
-                    "INSERT INTO rate_limits (key, request_time) VALUES (?, ?)",
-                    (key, datetime.now())
-                )
+            self._pending_success.append((key, _now_ts()))
 
-                # 更新统计信息，重置连续失败计数
-                conn.execute(
-                    '''UPDATE key_stats
-                       SET successful_requests = successful_requests + 1,
-                           consecutive_failures = 0,
-                           last_success = ?
-                       WHERE key = ?''',
-                    (datetime.now(), key)
-                )
+            # 无论是免费还是付费密钥成功，都重置免费密钥的全局连续失败计数
+            # 这是因为成功意味着服务是可用的，应该重新尝试免费密钥
+            self.free_key_consecutive_failures = 0
 
-                # 获取密钥类型
-                key_type = conn.execute(
-                    "SELECT key_type FROM api_keys WHERE key = ?",
-                    (key,)
-                ).fetchone()['key_type']
+            # 达到批量大小或距上次落库超过间隔时间时刷新
+            if (len(self._pending_success) >= self._pending_flush_size
+                    or time.monotonic() - self._last_success_flush >= self._pending_flush_interval):
+                self._flush_pending_success()
+
+    def _flush_pending_success(self):
+        """将缓冲的成功记录在单个事务中落库（调用方需持有 self.lock）"""
+        if not self._pending_success:
+            return
+
+        pending, self._pending_success = self._pending_success, []
+        with self._writer() as conn:
+            # 累加分钟桶与日桶计数（UPSERT，代替逐行插入）
+            conn.executemany(
+                _SQL_BUCKET_UPSERT,
+                [(k, 0, ts // 60) for k, ts in pending]
+                + [(k, 1, ts // 86400) for k, ts in pending]
+            )
 
-                # 无论是免费还是付费密钥成功，都重置免费密钥的全局连续失败计数
-                # 这是因为成功意味着服务是可用的，应该重新尝试免费密钥
-                conn.execute(
-                    "UPDATE global_state SET value = '0' WHERE key = 'free_key_consecutive_failures'"
-                )
-                self.free_key_consecutive_failures = 0
+            # 更新统计信息，重置连续失败计数
+            conn.executemany(
+                _SQL_SUCCESS_STATS,
+                [(ts, k) for k, ts in pending]
+            )
 
-                conn.commit()
-                logging.debug(f"{key_type}密钥成功完成请求，已重置免费密钥连续失败计数")
+            # 落库当前内存值而不是硬编码 '0'：缓冲的成功之后可能已有失败把
+            # 计数加回去，无条件清零会在重启后丢掉这些失败
+            conn.execute(
+                "UPDATE global_state SET value = ? WHERE key = 'free_key_consecutive_failures'",
+                (str(self.free_key_consecutive_failures),)
+            )
+
+            conn.commit()
+            self._last_success_flush = time.monotonic()
 
     def record_failure(self, key: str, error_code: int):
         """记录失败的API调用"""
         with self.lock:
-            with self._get_db_connection() as conn:
-                # 获取当前错误统计和密钥类型
-                result = conn.execute(
-                    '''SELECT s.error_counts, s.consecutive_failures, k.key_type
-                       FROM key_stats s
-                       JOIN api_keys k ON s.key = k.key
-                       WHERE s.key = ?''',
-                    (key,)
-                ).fetchone()
-
-                if result:
-                    error_counts = json.loads(result['error_counts'] or '{}')
-                    error_counts[str(error_code)] = error_counts.get(str(error_code), 0) + 1
-                    consecutive_failures = (result['consecutive_failures'] or 0) + 1
-                    key_type = result['key_type']
-
-                    # 更新统计信息
-                    conn.execute(
-                        '''UPDATE key_stats
-                           SET failed_requests = failed_requests + 1,
-                               consecutive_failures = ?,
-                               last_error_code = ?,
-                               last_error_time = ?,
-                               error_counts = ?
-                           WHERE key = ?''',
-                        (consecutive_failures, error_code, datetime.now(),
-                         json.dumps(error_counts), key)
-                    )
+            with self._writer() as conn:
+                # 单条 UPDATE 原子完成：失败计数、连续失败、错误时间；
+                # 错误分布走规范化的 key_errors 表，按 (key, code) UPSERT累加
+                cursor = conn.execute(
+                    '''UPDATE key_stats
+                       SET failed_requests = failed_requests + 1,
+                           consecutive_failures = COALESCE(consecutive_failures, 0) + 1,
+                           last_error_code = ?,
+                           last_error_time = ?
+                       WHERE key = ?''',
+                    (error_code, _now_ts(), key)
+                )
 
+                if cursor.rowcount:
+                    conn.execute(_SQL_ERROR_UPSERT, (key, str(error_code)))
                     # 如果是免费密钥失败，原子性地增加全局连续失败计数
-                    if key_type == 'free':
-                        # 使用数据库事务确保原子性
-                        current_failures = conn.execute(
-                            "SELECT value FROM global_state WHERE key = 'free_key_consecutive_failures'"
-                        ).fetchone()['value']
-
-                        new_failures = int(current_failures) + 1
-
-                        conn.execute(
-                            "UPDATE global_state SET value = ? WHERE key = 'free_key_consecutive_failures'",
-                            (str(new_failures),)
-                        )
-
-                        self.free_key_consecutive_failures = new_failures
-                        logging.debug(f"免费密钥连续失败次数: {self.free_key_consecutive_failures}")
+                    free_cursor = conn.execute(
+                        '''UPDATE global_state
+                           SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT)
+                           WHERE key = 'free_key_consecutive_failures'
+                           AND EXISTS (SELECT 1 FROM api_keys
+                                       WHERE key = ? AND key_type = 'free')''',
+                        (key,)
+                    )
+                    if free_cursor.rowcount:
+                        self.free_key_consecutive_failures += 1
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("免费密钥连续失败次数: %d", self.free_key_consecutive_failures)
 
-                    conn.commit()
+                conn.commit()
 
     def temporarily_suspend_key(self, key: str, duration_seconds: Optional[int] = None):
         """临时挂起密钥"""
         duration = duration_seconds or self.cooldown_seconds
         with self.lock:
-            with self._get_db_connection() as conn:
-                resume_time = datetime.now() + timedelta(seconds=duration)
+            with self._writer() as conn:
+                resume_time = _now_ts() + duration
                 conn.execute(
                     '''INSERT OR REPLACE INTO suspended_keys (key, resume_time, reason)
                        VALUES (?, ?, ?)''',
                     (key, resume_time, f"临时挂起 {duration} 秒")
                 )
                 conn.commit()
-                logging.info(f"密钥已被挂起 {duration} 秒")
+                # 直接把挂起时间写进缓存，无需整体失效后重查
+                self._suspended_cache[key] = resume_time
+                logger.info(f"密钥已被挂起 {duration} 秒")
 
     def mark_key_invalid(self, key: str):
         """标记密钥为永久无效"""
         with self.lock:
-            with self._get_db_connection() as conn:
+            with self._writer() as conn:
                 # 获取密钥类型
                 result = conn.execute(
                     "SELECT key_type FROM api_keys WHERE key = ?",
@@ -499,182 +832,153 @@ class APIKeyManager:
                     conn.execute("DELETE FROM suspended_keys WHERE key = ?", (key,))
 
                     conn.commit()
+                    self._invalidate_caches()
 
-                    # 更新对应的密钥文件
-                    self._update_key_files()
-
-                    logging.warning(f"{key_type}密钥已被永久移除")
+                    # 只重写受影响类型的密钥文件（复用当前连接）
+                    self._update_key_files(conn, key_type)
 
-    def _update_key_files(self):
-        """更新密钥文件，移除无效密钥"""
-        with self._get_db_connection() as conn:
-            # 获取活跃的免费密钥
-            free_keys = [row['key'] for row in
-                        conn.execute("SELECT key FROM api_keys WHERE is_active = 1 AND key_type = 'free'")]
+                    logger.warning(f"{key_type}密钥已被永久移除")
 
-            # 获取活跃的付费密钥
-            paid_keys = [row['key'] for row in
-                        conn.execute("SELECT key FROM api_keys WHERE is_active = 1 AND key_type = 'paid'")]
+    def _update_key_files(self, conn: sqlite3.Connection, key_type: Optional[str] = None):
+        """把活跃密钥写回文件；只处理指定类型，内容与缓存一致时跳过重写"""
+        types = [key_type] if key_type else ['free', 'paid']
+        for kt in types:
+            path = self.free_key_path if kt == 'free' else self.paid_key_path
+            keys = [row['key'] for row in conn.execute(
+                "SELECT key FROM api_keys WHERE is_active = 1 AND key_type = ?", (kt,))]
 
-        # 更新免费密钥文件
-        with open(self.free_key_path, 'w', encoding='utf-8') as f:
-            for key in free_keys:
-                f.write(f"{key}\n")
-
-        # 更新付费密钥文件
-        with open(self.paid_key_path, 'w', encoding='utf-8') as f:
-            for key in paid_keys:
-                f.write(f"{key}\n")
+            cached = self._key_file_cache.get(path)
+            if cached and set(cached[1]) == set(keys):
+                continue
+            self._write_key_file(path, keys)
 
     def get_status(self) -> Dict:
         """获取管理器状态"""
+        # 写锁只护住缓冲落库与清理；统计查询本身是只读的，在 WAL 下可与写并发
         with self.lock:
-            self._cleanup_expired_data()
-
-            with self._get_db_connection() as conn:
-                # 获取总的可用密钥数量
-                total_available = conn.execute('''
-                    SELECT COUNT(*) as count
-                    FROM api_keys k
-                    WHERE k.is_active = 1
-                    AND k.key NOT IN (SELECT key FROM suspended_keys WHERE resume_time > ?)
-                ''', (datetime.now(),)).fetchone()['count']
-
-                # 获取被挂起的密钥数量
-                total_suspended = conn.execute('''
-                    SELECT COUNT(DISTINCT sk.key) as count
-                    FROM suspended_keys sk
-                    JOIN api_keys k ON sk.key = k.key
-                    WHERE k.is_active = 1
-                    AND sk.resume_time > ?
-                ''', (datetime.now(),)).fetchone()['count']
-
-                # 获取分类统计
-                type_stats = {}
-                for row in conn.execute('''
-                    SELECT key_type,
-                           COUNT(*) as total,
-                           COUNT(CASE WHEN key NOT IN
-                                 (SELECT key FROM suspended_keys WHERE resume_time > ?) THEN 1 END) as available
-                    FROM api_keys
-                    WHERE is_active = 1
-                    GROUP BY key_type
-                ''', (datetime.now(),)):
-                    type_stats[row['key_type']] = {
-                        'total': row['total'],
-                        'available': row['available'],
-                        'suspended': row['total'] - row['available']
+            self._flush_pending_success()
+            self._maybe_cleanup_expired_data()
+
+        with self._reader() as conn:
+            # 单次往返取回全部统计行，按 metric 标签分发
+            rows = conn.execute(_SQL_STATUS, (_now_ts(),)).fetchall()
+
+            type_stats = {}
+            type_requests = {}
+            error_dist = {}
+            total_success = 0
+            total_failed = 0
+
+            for row in rows:
+                if row['metric'] == 'types':
+                    type_stats[row['name']] = {
+                        'total': row['v1'],
+                        'available': row['v2'],
+                        'suspended': row['v1'] - row['v2']
                     }
-
-                # 获取请求统计
-                request_stats = conn.execute('''
-                    SELECT
-                        k.key_type,
-                        SUM(s.successful_requests) as success,
-                        SUM(s.failed_requests) as failed
-                    FROM key_stats s
-                    JOIN api_keys k ON s.key = k.key
-                    WHERE k.is_active = 1
-                    GROUP BY k.key_type
-                ''').fetchall()
-
-                type_requests = {}
-                total_success = 0
-                total_failed = 0
-
-                for row in request_stats:
-                    type_requests[row['key_type']] = {
-                        'successful': row['success'] or 0,
-                        'failed': row['failed'] or 0
+                elif row['metric'] == 'requests':
+                    type_requests[row['name']] = {
+                        'successful': row['v1'] or 0,
+                        'failed': row['v2'] or 0
                     }
-                    total_success += row['success'] or 0
-                    total_failed += row['failed'] or 0
-
-                # 获取错误分布
-                error_dist = {}
-                for row in conn.execute("SELECT error_counts FROM key_stats WHERE error_counts != '{}'"):
-                    counts = json.loads(row['error_counts'])
-                    for code, count in counts.items():
-                        error_dist[code] = error_dist.get(code, 0) + count
-
-                return {
-                    "available_keys": total_available,  # 所有可用密钥的总数
-                    "suspended_keys": total_suspended,  # 新增字段：所有被挂起密钥的总数
-                    "key_statistics": type_stats,
-                    "request_statistics": type_requests,
-                    "total_successful_requests": total_success,
-                    "total_failed_requests": total_failed,
-                    "free_key_consecutive_failures": self.free_key_consecutive_failures,
-                    "max_free_key_failures": self.max_free_key_failures,
-                    "rate_limits": {
-                        "requests_per_minute": self.requests_per_minute,
-                        "requests_per_day": self.requests_per_day
-                    },
-                    "error_distribution": error_dist
-                }
+                    total_success += row['v1'] or 0
+                    total_failed += row['v2'] or 0
+                else:  # errors
+                    error_dist[row['name']] = row['v1']
+
+            # 可用/挂起总数由分类统计推导，省去两次单独的 COUNT 查询
+            total_available = sum(t['available'] for t in type_stats.values())
+            total_suspended = sum(t['suspended'] for t in type_stats.values())
+
+            return {
+                "available_keys": total_available,  # 所有可用密钥的总数
+                "suspended_keys": total_suspended,  # 新增字段：所有被挂起密钥的总数
+                "key_statistics": type_stats,
+                "request_statistics": type_requests,
+                "total_successful_requests": total_success,
+                "total_failed_requests": total_failed,
+                "free_key_consecutive_failures": self.free_key_consecutive_failures,
+                "max_free_key_failures": self.max_free_key_failures,
+                "rate_limits": {
+                    "requests_per_minute": self.requests_per_minute,
+                    "requests_per_day": self.requests_per_day
+                },
+                "error_distribution": error_dist
+            }
 
     def get_detailed_key_status(self, key_prefix: str) -> Dict:
         """获取特定密钥的详细状态"""
-        with self.lock:
-            with self._get_db_connection() as conn:
-                query = '''
-                    SELECT
-                        k.key, k.is_active, k.key_type,
-                        s.total_requests, s.successful_requests, s.failed_requests,
-                        s.consecutive_failures,                        s.last_used, s.last_success, s.last_error_code, s.last_error_time,
-                        sk.resume_time,
-                        (SELECT COUNT(*) FROM rate_limits r
-                         WHERE r.key = k.key AND r.request_time > ?) as requests_today
-                    FROM api_keys k
-                    LEFT JOIN key_stats s ON k.key = s.key
-                    LEFT JOIN suspended_keys sk ON k.key = sk.key
-                    WHERE k.key LIKE ?
-                    LIMIT 5
-                '''
-
-                day_ago = datetime.now() - timedelta(days=1)
-                rows = conn.execute(query, (day_ago, f"{key_prefix}%")).fetchall()
-
-                if not rows:
-                    return {"error": "未找到匹配的密钥"}
-
-                details = []
-                for row in rows:
-                    details.append({
-                        "key": row['key'],
-                        "key_type": row['key_type'],
-                        "is_active": bool(row['is_active']),
-                        "is_suspended": row['resume_time'] is not None and row['resume_time'] > datetime.now(),
-                        "stats": {
-                            "total_requests": row['total_requests'] or 0,
-                            "successful_requests": row['successful_requests'] or 0,
-                            "failed_requests": row['failed_requests'] or 0,
-                            "consecutive_failures": row['consecutive_failures'] or 0,
-                            "requests_today": row['requests_today'],
-                            "last_used": row['last_used'],
-                            "last_success": row['last_success'],
-                            "last_error": {
-                                "code": row['last_error_code'],
-                                "time": row['last_error_time']
-                            } if row['last_error_code'] else None
-                        }
-                    })
-
-                return {
-                    "matching_keys_count": len(rows),
-                    "details": details
-                }
+        # 纯只读路径：线程本地的 query_only 连接在 WAL 下可与写并发，无需拿写锁
+        with self._reader() as conn:
+            # 用预聚合的CTE代替逐行求值的相关子查询，一次分组扫描即可
+            query = '''
+                WITH recent AS (
+                    SELECT key, SUM(cnt) as c
+                    FROM rate_buckets
+                    WHERE bucket_kind = 1 AND bucket_id > ?
+                    GROUP BY key
+                )
+                SELECT
+                    k.key, k.is_active, k.key_type,
+                    s.total_requests, s.successful_requests, s.failed_requests,
+                    s.consecutive_failures,
+                    s.last_used, s.last_success, s.last_error_code, s.last_error_time,
+                    sk.resume_time,
+                    COALESCE(recent.c, 0) as requests_today
+                FROM api_keys k
+                LEFT JOIN key_stats s ON k.key = s.key
+                LEFT JOIN suspended_keys sk ON k.key = sk.key
+                LEFT JOIN recent ON recent.key = k.key
+                WHERE k.key >= ? AND k.key < ?
+                LIMIT 5
+            '''
+
+            day_cutoff = (_now_ts() - 86400) // 86400 - 1
+            # 前缀匹配改写成主键范围扫描：LIKE 受大小写折叠影响，优化器不保证走索引
+            rows = conn.execute(
+                query, (day_cutoff, key_prefix, key_prefix + '\uffff')
+            ).fetchall()
+
+            if not rows:
+                return {"error": "未找到匹配的密钥"}
+
+            details = []
+            for row in rows:
+                details.append({
+                    "key": row['key'],
+                    "key_type": row['key_type'],
+                    "is_active": bool(row['is_active']),
+                    "is_suspended": row['resume_time'] is not None and row['resume_time'] > _now_ts(),
+                    "stats": {
+                        "total_requests": row['total_requests'] or 0,
+                        "successful_requests": row['successful_requests'] or 0,
+                        "failed_requests": row['failed_requests'] or 0,
+                        "consecutive_failures": row['consecutive_failures'] or 0,
+                        "requests_today": row['requests_today'],
+                        "last_used": row['last_used'],
+                        "last_success": row['last_success'],
+                        "last_error": {
+                            "code": row['last_error_code'],
+                            "time": row['last_error_time']
+                        } if row['last_error_code'] else None
+                    }
+                })
+
+            return {
+                "matching_keys_count": len(rows),
+                "details": details
+            }
 
     def reset_free_key_failures(self):
         """手动重置免费密钥连续失败计数"""
         with self.lock:
-            with self._get_db_connection() as conn:
+            with self._writer() as conn:
                 conn.execute(
                     "UPDATE global_state SET value = '0' WHERE key = 'free_key_consecutive_failures'"
                 )
                 conn.commit()
             self.free_key_consecutive_failures = 0
-            logging.info("已重置免费密钥连续失败计数")
+            logger.info("已重置免费密钥连续失败计数")
 
     def get_key_by_type(self, key_type: str = 'free') -> str:
         """根据类型获取密钥"""
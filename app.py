@@ -1,48 +1,288 @@
 import time
+import logging
 import markdown2
-# import pygetwindow as gw # 截图部分保持不变
 import pyautogui
 import tkinter as tk
 import requests
 import base64
 import io
 import json # 确保导入 json
-from flask import Flask, Response, render_template, request, jsonify, send_from_directory, render_template_string # 引入 Response 和 render_template_string
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, render_template_string, stream_with_context # 引入 Response 和 render_template_string
 from config import key_manager, MODEL_BASE_URL, PORT, BASE_PROMPT, MODELS, NoAvailableKeysError
 from PIL import Image
 from threading import Lock
+from collections import deque
 from datetime import datetime
 from urllib.parse import quote
 import hashlib
+import itertools
+from functools import lru_cache
 from json import JSONDecodeError
 from json import JSONDecoder
 import re
-
+import string
+
+# 可选的 orjson：原生实现的JSON编解码，小对象快数倍；未安装时退回标准库
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps_bytes = orjson.dumps
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _loads = json.loads
+    _dumps = json.dumps
+
+    def _dumps_bytes(obj):
+        return json.dumps(obj).encode()
+
+# 可选的 mss：平台原生 BitBlt 抓屏，比 pyautogui 的 GDI 路径少几次拷贝；
+# 未安装时退回 pyautogui
+try:
+    import mss
+except ImportError:
+    mss = None
+
+# 可选的 pygetwindow：只在截图时用来最小化/恢复当前窗口，
+# 导入一次，不在每次截图的函数体内重复 import
+try:
+    import pygetwindow as gw
+except ImportError:
+    gw = None
+
+# JPEG 编码是图片路径的热点：libjpeg-turbo（SIMD）比 stock libjpeg 快数倍。
+# 启动时检查一次，提示可通过安装 Pillow-SIMD 获得免费加速
+try:
+    from PIL import features as _pil_features
+    if not _pil_features.check_feature('libjpeg_turbo'):
+        print("提示：当前 Pillow 未链接 libjpeg-turbo，图片压缩较慢；"
+              "可安装 Pillow-SIMD 获得 4-6 倍的 JPEG 编码加速")
+except Exception:
+    pass
 
 
 # ----------------- 基础配置 -----------------
+# 流式热路径统一走 logging 的 %-懒格式化：级别不启用时连字符串都不拼
+logger = logging.getLogger(__name__)
+
 HEADERS = {"Content-Type": "application/json"}
+
+# 复用 TCP/TLS 连接：TLS 握手约 2 个 RTT，连接池让后续请求免去逐次握手
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=16, pool_maxsize=64, max_retries=0))
+SESSION.headers.update(HEADERS)
+
+# SSE 帧的固定框架预先拼好：每个token只编码裸字符串，省去逐帧构建字典
+def _sse_text_frame(text):
+    return 'data: {"text":' + _dumps(text) + '}\n\n'
+
+_SSE_END = "event: end\ndata: [DONE]\n\n"
+
+# SSE 响应头：提示反向代理与浏览器不要缓冲，保证逐token送达
+_SSE_HEADERS = {
+    'X-Accel-Buffering': 'no',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+}
+
+# 状态码 -> 密钥处置的分发表：认证类错误永久移除，其余（限流/服务端错误等）
+# 一律临时挂起；新语义只需加一行表项，不用再改分支链
+_STATUS_KEY_ACTION = {
+    429: ('temporarily_suspend_key', '因达到速率限制被临时挂起'),
+    400: ('mark_key_invalid', '因认证失败被永久移除'),
+    403: ('mark_key_invalid', '因认证失败被永久移除'),
+    500: ('temporarily_suspend_key', '因服务器错误被临时挂起'),
+    502: ('temporarily_suspend_key', '因服务器错误被临时挂起'),
+    503: ('temporarily_suspend_key', '因服务器错误被临时挂起'),
+    504: ('temporarily_suspend_key', '因服务器错误被临时挂起'),
+}
+
 chat_history_lock = Lock()  # 全局锁
 # 用于实现“能力保持”的变量，记录上一次成功请求的key
 last_successful_key = None
 
 app = Flask(__name__, template_folder='templates')
-chat_history = [] # 直接保存成 Google Gemini 兼容格式（role / parts）
-# 用于存储流式传输中积累的完整机器人回复
-current_bot_response_full = ""
+# 直接保存成 Google Gemini 兼容格式（role / parts）；maxlen 给内存兜底：
+# 超长会话自动淘汰最旧消息，避免历史无限增长
+chat_history = deque(maxlen=200)
+# 只读快照：追加后整体重建并原子换引用，读路径无锁取用
+_history_snapshot = ()
+
+# /history 的预渲染视图：消息一经追加便不再变化，渲染一次存下来，
+# 页面刷新时只剩一次 jsonify，不再逐条重建 markdown 字符串
+_preview_history = deque(maxlen=200)
+_preview_snapshot = ()
+
+def _msg_image_refs(msg):
+    """枚举消息 parts 中的图片引用"""
+    for p in msg.get('parts', []):
+        if isinstance(p, dict):
+            ref = (p.get('inline_data') or {}).get('ref')
+            if ref:
+                yield ref
+
+def _append_history(msg):
+    """追加消息并发布新的只读快照（引用重绑定在GIL下是原子的）"""
+    global _history_snapshot, _preview_snapshot
+    # deque 满时最旧的消息即将被淘汰：先记下它，随后释放其独占的图片
+    evicted = chat_history[0] if len(chat_history) == chat_history.maxlen else None
+    chat_history.append(msg)
+    for ref in _msg_image_refs(msg):
+        _image_refcount[ref] = _image_refcount.get(ref, 0) + 1
+    if evicted is not None:
+        for ref in _msg_image_refs(evicted):
+            remaining = _image_refcount.get(ref, 0) - 1
+            if remaining > 0:
+                _image_refcount[ref] = remaining
+            else:
+                # 没有其他消息再引用该图片，连同 blob 一起删除，防止长会话内存泄漏
+                _image_refcount.pop(ref, None)
+                _image_store.pop(ref, None)
+    _history_snapshot = tuple(chat_history)
+    _preview_history.append(_render_preview(msg))
+    _preview_snapshot = tuple(_preview_history)
+
+# 图片内容寻址存储：历史里只放轻量引用，避免快照重建与 /stream 拷贝
+# 反复搬运 MB 级的 base64 字符串；出站调用时才展开一次。
+# 每个引用按历史中的消息计数（_append_history 维护），消息被 deque 淘汰时
+# 减计数，归零即删除 blob，保证 maxlen 对图片内存同样生效
+_image_store = {}
+_image_refcount = {}
+
+def _store_image(mime, b64data):
+    """存入图片并返回带引用的 part（同图去重）"""
+    ref = hashlib.blake2b(b64data.encode(), digest_size=16).hexdigest()
+    _image_store.setdefault(ref, b64data)
+    return {'inline_data': {'mime_type': mime, 'ref': ref}}
+
+def _image_data(part):
+    """取出 part 的图片 base64（兼容引用与旧式内联两种形态）"""
+    idata = part.get('inline_data') or {}
+    if 'ref' in idata:
+        return _image_store.get(idata['ref'], '')
+    return idata.get('data', '')
+
+def _materialize(history):
+    """把历史中的图片引用展开成 Gemini 负载的内联数据（每次出站调用只做一次）"""
+    out = []
+    for msg in history:
+        parts = msg.get('parts', [])
+        if any(isinstance(p, dict) and 'ref' in (p.get('inline_data') or {}) for p in parts):
+            new_parts = []
+            for p in parts:
+                idata = p.get('inline_data') if isinstance(p, dict) else None
+                if idata and 'ref' in idata:
+                    new_parts.append({'inline_data': {
+                        'mime_type': idata.get('mime_type', 'image/png'),
+                        'data': _image_store.get(idata['ref'], '')
+                    }})
+                else:
+                    new_parts.append(p)
+            out.append({'role': msg.get('role'), 'parts': new_parts})
+        else:
+            out.append(msg)
+    return out
+
+# 出站历史的字节预算：历史是无限增长的，而每一轮都会把全部旧图片重新上传，
+# 上行带宽与序列化成本随轮数线性膨胀；超预算时从最旧的消息开始裁掉
+_HISTORY_BYTE_BUDGET = 2_000_000
+
+def _trim_history(history):
+    """按字节预算裁剪出站历史：保留首条（携带 BASE_PROMPT）与最近的消息"""
+    sizes = []
+    total = 0
+    for msg in history:
+        sz = 0
+        for p in msg.get('parts', []):
+            if not isinstance(p, dict):
+                continue
+            sz += len(p.get('text', ''))
+            idata = p.get('inline_data') or {}
+            if 'ref' in idata:
+                sz += len(_image_store.get(idata['ref'], ''))
+            else:
+                sz += len(idata.get('data', ''))
+        sizes.append(sz)
+        total += sz
+    if total <= _HISTORY_BYTE_BUDGET:
+        return history
+
+    # 从第二条开始丢最旧的消息；最后一条（本轮输入）无论多大都保留
+    keep_from = 1
+    while keep_from < len(history) - 1 and total > _HISTORY_BYTE_BUDGET:
+        total -= sizes[keep_from]
+        keep_from += 1
+    return tuple(history[:1]) + tuple(history[keep_from:])
+
+def _render_preview(msg):
+    """把一条消息渲染成 /history 的 {who, md} 视图（追加时调用一次）"""
+    role = msg.get('role')
+    if role == 'user':
+        md = ''
+        for part in msg.get('parts', []):
+            if 'text' in part:
+                md += part['text'] + '\n'  # 用户输入按原逻辑，允许多行
+            if 'inline_data' in part:
+                md += '<br><br>![alt text](data:%s;base64,%s)\n' % (
+                    part['inline_data'].get('mime_type', 'image/png'),
+                    (_image_data(part)[:30] + '...')
+                )
+        return {'who': 'user', 'md': md}
+
+    if role == 'model':
+        parts = msg.get('parts', [])
+        if not parts:
+            return {'who': 'bot', 'md': '[空回复或格式错误]'}
+
+        md = ''
+        text_buffer = []
+
+        def flush_md_text():
+            nonlocal md, text_buffer
+            if text_buffer:
+                # 不额外添加换行，直接拼接，保持一句话连续
+                md += ''.join(text_buffer)
+                text_buffer = []
+
+        for part in parts:
+            if 'text' in part and part['text']:
+                text_buffer.append(part['text'])
+            elif 'inline_data' in part:
+                # 先把已有文本 flush，再插入图片占位
+                flush_md_text()
+                mime = part['inline_data'].get('mime_type', 'image/png')
+                data_b64 = _image_data(part)
+                if data_b64:
+                    md += f'\n![ai image](data:{mime};base64,{data_b64[:30]}...)\n'
+
+        flush_md_text()
+        if not md.strip():
+            md = '[空回复]'
+        return {'who': 'bot', 'md': md}
+
+    # 未知角色兜底
+    return {'who': 'bot', 'md': '[未知消息类型]'}
 
 # ------- 在原有 Flask 路由后面加上两个新接口 --------
 @app.route('/reset', methods=['POST'])
 def reset():
-    global chat_history, current_bot_response_full, last_successful_key
-    chat_history.clear()
-    current_bot_response_full = "" # 重置时也清空
+    global chat_history, _history_snapshot, _preview_snapshot, last_successful_key
+    with chat_history_lock:
+        chat_history.clear()
+        _history_snapshot = ()
+        _preview_history.clear()
+        _preview_snapshot = ()
+        _image_store.clear()
+        _image_refcount.clear()
+    _render_text_part.cache_clear()
     last_successful_key = None
     return jsonify({'ok': True})
 
 def stream_gemini_response(history, model, tools=None):
-    global current_bot_response_full, chat_history, last_successful_key
-    current_bot_response_full = ""
+    global last_successful_key
 
     # 用于收集本次模型的完整 parts（含 text 与 inline_data）
     model_parts_collected = []
@@ -88,34 +328,41 @@ def stream_gemini_response(history, model, tools=None):
     max_retries = status0["available_keys"]
     if max_retries == 0:
         error_msg = "错误：密钥池中没有可用的密钥。"
-        current_bot_response_full = error_msg
-        yield f"data: {json.dumps({'text': error_msg})}\n\n"
-        yield "event: end\ndata: [DONE]\n\n"
+        yield _sse_text_frame(error_msg)
+        yield _SSE_END
         return
 
+    # 负载在一次流式调用内不变：物化、裁剪、序列化各做一次，
+    # 密钥轮换重试时直接复用同一份字节串（带图历史可达数 MB/次）
+    payload = {"contents": _materialize(_trim_history(history))}
+    if tools:
+        payload["tools"] = tools
+    body = _dumps_bytes(payload)
+
     for attempt in range(max_retries):
         api_key = None
         try:
             # 调用新的 get_key 方法，并传入上一次成功的 key 作为首选
             api_key = key_manager.get_key(preferred_key=last_successful_key, force_paid=False)
 
-            # 获取密钥详细信息
-            key_status = key_manager.get_detailed_key_status(api_key)
-            key_type = "未知"
-            if key_status.get('details') and len(key_status['details']) > 0:
-                key_type = key_status['details'][0].get('key_type', '未知')
-            print(
-                f"正在使用 API Key: {api_key} (尝试 {attempt + 1}/{max_retries})"
-                f"\n当前key层级：{key_type}"
-                f"\n免费层级失败次数：{key_manager.get_status()['free_key_consecutive_failures']}"
-            )
+            # 密钥层级的详细点查只在 debug 模式做；常规运行一行轻量日志即可，
+            # 失败计数直接读内存镜像，不为日志再查库
+            if app.debug:
+                key_status = key_manager.get_detailed_key_status(api_key)
+                key_type = "未知"
+                if key_status.get('details') and len(key_status['details']) > 0:
+                    key_type = key_status['details'][0].get('key_type', '未知')
+                logger.debug(
+                    "正在使用 API Key: %s (尝试 %d/%d)\n当前key层级：%s\n免费层级失败次数：%s",
+                    api_key, attempt + 1, max_retries, key_type,
+                    key_manager.free_key_consecutive_failures)
+            else:
+                logger.info("正在使用 API Key: %s (尝试 %d/%d)", api_key, attempt + 1, max_retries)
 
             url = f"{MODEL_BASE_URL}{model}:streamGenerateContent?alt=sse&key={api_key}"
-            payload = {"contents": history}
-            if tools:
-                payload["tools"] = tools
 
-            with requests.post(url, headers=HEADERS, json=payload, stream=True, timeout=300) as resp:
+            # 连接/读取超时分开：连不上 5 秒即失败换下一把密钥，读取仍给满 300 秒
+            with SESSION.post(url, data=body, stream=True, timeout=(5, 300)) as resp:
                 resp.raise_for_status()
                 # 保存响应内容,便于debug
                 # with open('content.txt', 'w', encoding='utf-8') as f:
@@ -125,34 +372,73 @@ def stream_gemini_response(history, model, tools=None):
 
                 decoder = JSONDecoder()
 
+                # 合并细碎的 token 增量：上游常一次只推 1~3 个字符，逐个成帧
+                # 会放大网络帧数与前端重绘次数；攒到 64 字符或距上次下发
+                # 超过 25ms 再发一帧，延迟感知不到但帧数少一个数量级
+                pending = []
+                pending_len = 0
+                last_flush = time.monotonic()
+
+                def _flush_pending():
+                    nonlocal pending_len, last_flush
+                    merged = ''.join(pending)
+                    pending.clear()
+                    pending_len = 0
+                    last_flush = time.monotonic()
+                    model_parts_collected.append({'text': merged})
+                    return _sse_text_frame(merged)
+
+                def _iter_data_payloads():
+                    """按原始字节切行，只把 data: 行的负载解码成字符串。
+
+                    iter_lines 会为每一行（包括 keepalive 空行和 event: 行）
+                    各做一次 UTF-8 解码与字符串分配；这里空行/事件行在字节
+                    层面就被跳过，每条负载只解码一次。
+                    """
+                    buf = bytearray()
+                    for chunk in resp.iter_content(chunk_size=16384):
+                        if not chunk:
+                            continue
+                        buf += chunk
+                        start = 0
+                        while True:
+                            nl = buf.find(b'\n', start)
+                            if nl < 0:
+                                break
+                            line = bytes(buf[start:nl])
+                            start = nl + 1
+                            if line.startswith(b'data: '):
+                                yield line[6:].strip().decode('utf-8', errors='ignore')
+                        del buf[:start]
+
                 # 流式处理响应
-                for raw_line in resp.iter_lines():
-                    if not raw_line:
-                        continue
-                    decoded_line = raw_line.decode('utf-8', errors='ignore')
-                    if not decoded_line.startswith('data: '):
+                for s in _iter_data_payloads():
+                    if not s or s[0] != '{':
+                        # 非 JSON 起始（例如 [DONE]），跳过这一行
                         continue
 
-                    # 可能出现多个 JSON 连在一个 data: 后面 → 使用 raw_decode 连续解码
-                    s = decoded_line[6:].strip()
-                    idx = 0
-                    n = len(s)
-                    while idx < n:
-                        # 跳过空白
-                        while idx < n and s[idx].isspace():
-                            idx += 1
-                        if idx >= n:
-                            break
-                        if s[idx] != '{':
-                            # 遇到非 JSON 起始（例如 [DONE]），中止这一行
-                            break
-                        try:
-                            obj, consumed = decoder.raw_decode(s, idx)
-                            idx = consumed
-                        except JSONDecodeError:
-                            # 半包或异常，放弃这一行剩余内容
-                            break
-
+                    # 快速路径：整行就是一个 JSON 对象，直接用 _loads 解析；
+                    # 多个 JSON 连在一个 data: 后面时退回 raw_decode 连续解码
+                    try:
+                        objs = [_loads(s)]
+                    except ValueError:
+                        objs = []
+                        idx = 0
+                        n = len(s)
+                        while idx < n:
+                            # 跳过空白
+                            while idx < n and s[idx].isspace():
+                                idx += 1
+                            if idx >= n or s[idx] != '{':
+                                break
+                            try:
+                                obj, idx = decoder.raw_decode(s, idx)
+                            except JSONDecodeError:
+                                # 半包或异常，放弃这一行剩余内容
+                                break
+                            objs.append(obj)
+
+                    for obj in objs:
                         try:
                             candidates = obj.get('candidates', [])
                             if not candidates:
@@ -160,7 +446,7 @@ def stream_gemini_response(history, model, tools=None):
                             content = candidates[0].get('content', {}) or {}
                             parts = content.get('parts', []) or []
                         except Exception as e:
-                            print(f"SSE 对象结构异常: {e}")
+                            logger.warning("SSE 对象结构异常: %s", e)
                             continue
 
                         # 遍历本次 JSON 对象里的所有 parts
@@ -173,13 +459,18 @@ def stream_gemini_response(history, model, tools=None):
                             if 'text' in norm:
                                 text_chunk = norm['text']
                                 if text_chunk:
-                                    current_bot_response_full += text_chunk
-                                    model_parts_collected.append({'text': text_chunk})
-                                    # 仍旧通过默认 message 事件向前端推送文本
-                                    yield f"data: {json.dumps({'text': text_chunk})}\n\n"
+                                    pending.append(text_chunk)
+                                    pending_len += len(text_chunk)
+                                    if (pending_len >= 64
+                                            or time.monotonic() - last_flush > 0.025):
+                                        # 仍旧通过默认 message 事件向前端推送文本
+                                        yield _flush_pending()
 
                             # 图片
                             elif 'inline_data' in norm:
+                                # 先冲刷攒着的文本，保证图文顺序
+                                if pending:
+                                    yield _flush_pending()
                                 mime_type = norm['inline_data'].get('mime_type', 'image/png')
                                 b64data = norm['inline_data'].get('data', '')
                                 if b64data:
@@ -189,162 +480,289 @@ def stream_gemini_response(history, model, tools=None):
                                         emitted_image_hashes.add(h)
                                         # 推送图片事件
                                         payload_img = {'mime_type': mime_type, 'data': b64data}
-                                        yield f"event: image\ndata: {json.dumps(payload_img)}\n\n"
-                                        # 记录到 parts
-                                        model_parts_collected.append({
-                                            'inline_data': {'mime_type': mime_type, 'data': b64data}
-                                        })
+                                        yield f"event: image\ndata: {_dumps(payload_img)}\n\n"
+                                        # 记录到 parts（历史中只存引用）
+                                        model_parts_collected.append(_store_image(mime_type, b64data))
+
+                # 收尾：发出缓冲中剩余的文本
+                if pending:
+                    yield _flush_pending()
 
                 # 成功完成流
                 key_manager.record_success(api_key)
                 last_successful_key = api_key
-                print(f"API调用成功，使用密钥: {api_key}")
+                logger.info("API调用成功，使用密钥: %s", api_key)
                 break
 
         except NoAvailableKeysError as e:
-            print(f"获取密钥失败: {e}")
+            logger.warning("获取密钥失败: %s", e)
             error_msg = f"错误: {e}"
-            current_bot_response_full = error_msg
-            yield f"data: {json.dumps({'text': error_msg})}\n\n"
+            yield _sse_text_frame(error_msg)
             break
 
         except requests.exceptions.HTTPError as e:
-            print(f"请求失败 (API Key: {api_key}): {e}")
+            logger.warning("请求失败 (API Key: %s): %s", api_key, e)
             status_code = e.response.status_code
 
-            # 记录失败并根据错误处理密钥
+            # 记录失败并按分发表处置密钥
             if api_key:
                 key_manager.record_failure(api_key, status_code)
-                if status_code == 429:
-                    key_manager.temporarily_suspend_key(api_key)
-                    print(f"密钥 {api_key} 因达到速率限制被临时挂起")
-                elif status_code in [400, 403]:
-                    key_manager.mark_key_invalid(api_key)
-                    print(f"密钥 {api_key} 因认证失败被永久移除")
-                elif status_code >= 500:
-                    key_manager.temporarily_suspend_key(api_key)
-                    print(f"密钥 {api_key} 因服务器错误被临时挂起")
-                else:
-                    key_manager.temporarily_suspend_key(api_key)
-                    print(f"密钥 {api_key} 因错误 {status_code} 被临时挂起")
+                method, reason = _STATUS_KEY_ACTION.get(
+                    status_code,
+                    ('temporarily_suspend_key', f'因错误 {status_code} 被临时挂起'))
+                getattr(key_manager, method)(api_key)
+                logger.warning("密钥 %s %s", api_key, reason)
 
             if attempt >= max_retries - 1:
                 error_msg = f"所有密钥均尝试失败。最后错误状态码: {status_code}"
-                current_bot_response_full = error_msg
-                yield f"data: {json.dumps({'text': error_msg})}\n\n"
+                yield _sse_text_frame(error_msg)
 
         except Exception as e:
-            print(f"处理流时发生未知错误: {e}")
+            logger.error("处理流时发生未知错误: %s", e)
             if api_key:
                 key_manager.record_failure(api_key, 0)  # 0 表示未知错误
                 key_manager.temporarily_suspend_key(api_key)
             error_msg = f"处理流失败: {e}"
-            current_bot_response_full = error_msg
-            yield f"data: {json.dumps({'text': error_msg})}\n\n"
+            yield _sse_text_frame(error_msg)
             if attempt >= max_retries - 1:
                 break
 
-    # 输出当前密钥池状态
+    # 输出当前密钥池状态：拼成一条再写，只过一次 stdout 锁
     status = key_manager.get_status()
-    print("密钥池状态汇总:")
-    print(f"- 可用密钥总数: {status['available_keys']}")
-    print(f"- 挂起密钥总数: {status['suspended_keys']}")
-    print(f"- 免费密钥连续失败: {status['free_key_consecutive_failures']}/{status['max_free_key_failures']}")
+    summary = [
+        "密钥池状态汇总:",
+        f"- 可用密钥总数: {status['available_keys']}",
+        f"- 挂起密钥总数: {status['suspended_keys']}",
+        f"- 免费密钥连续失败: {status['free_key_consecutive_failures']}/{status['max_free_key_failures']}",
+    ]
     for key_type, stats in status['key_statistics'].items():
-        print(f"- {key_type}密钥: 总数：{stats['total']}, 可用：{stats['available']}, 挂起：{stats['suspended']}")
+        summary.append(f"- {key_type}密钥: 总数：{stats['total']}, 可用：{stats['available']}, 挂起：{stats['suspended']}")
+    logger.info('%s', '\n'.join(summary))
 
     # 将模型回复添加到 chat_history：用收集到的 parts（含图片）
     if model_parts_collected:
         with chat_history_lock:
             # 只有当历史记录的最后一条是'user'时才添加'model'回复，防止重复添加
             if not chat_history or chat_history[-1]['role'] == 'user':
-                chat_history.append({'role': 'model', 'parts': model_parts_collected})
-
-    yield "event: end\ndata: [DONE]\n\n"
-    time.sleep(0.1)
-
-@app.route('/export', methods=['GET'])
-def export_history():
-    """
-    导出对话历史为HTML格式
-    """
-    global chat_history
+                _append_history({'role': 'model', 'parts': model_parts_collected})
+
+    yield _SSE_END
+
+# ----------------- 导出渲染常量（模块导入时编译一次，不在每次导出重建） -----------------
+_CODE_FENCE_RE = re.compile(r'```[\s\S]*?```')
+_INLINE_CODE_RE = re.compile(r'`[^`]+`')
+_MATH_BLOCK_RE = re.compile(r'\$\$(.*?)\$\$', re.DOTALL)
+_INLINE_MATH_RE = re.compile(r'\$([^$]+)\$')
+_SUP_BRACE_RE = re.compile(r'\^\{([^}]+)\}')
+_SUP_CHAR_RE = re.compile(r'\^(\w)')
+_SUB_BRACE_RE = re.compile(r'_\{([^}]+)\}')
+_SUB_CHAR_RE = re.compile(r'_(\w)')
+_CODE_WRAP_RE = re.compile(r'<pre><code[^>]*?>(.*?)</code></pre>', re.DOTALL)
+
+# 常见 LaTeX 命令到 Unicode 符号的映射
+_MATH_SYMBOLS = {
+    r'\alpha': 'α', r'\beta': 'β', r'\gamma': 'γ', r'\delta': 'δ',
+    r'\epsilon': 'ε', r'\zeta': 'ζ', r'\eta': 'η', r'\theta': 'θ',
+    r'\iota': 'ι', r'\kappa': 'κ', r'\lambda': 'λ', r'\mu': 'μ',
+    r'\nu': 'ν', r'\xi': 'ξ', r'\pi': 'π', r'\rho': 'ρ',
+    r'\sigma': 'σ', r'\tau': 'τ', r'\upsilon': 'υ', r'\phi': 'φ',
+    r'\chi': 'χ', r'\psi': 'ψ', r'\omega': 'ω',
+    r'\Alpha': 'Α', r'\Beta': 'Β', r'\Gamma': 'Γ', r'\Delta': 'Δ',
+    r'\Epsilon': 'Ε', r'\Zeta': 'Ζ', r'\Eta': 'Η', r'\Theta': 'Θ',
+    r'\Iota': 'Ι', r'\Kappa': 'Κ', r'\Lambda': 'Λ', r'\Mu': 'Μ',
+    r'\Nu': 'Ν', r'\Xi': 'Ξ', r'\Pi': 'Π', r'\Rho': 'Ρ',
+    r'\Sigma': 'Σ', r'\Tau': 'Τ', r'\Upsilon': 'Υ', r'\Phi': 'Φ',
+    r'\Chi': 'Χ', r'\Psi': 'Ψ', r'\Omega': 'Ω',
+    r'\sum': '∑', r'\prod': '∏', r'\int': '∫', r'\oint': '∮',
+    r'\partial': '∂', r'\nabla': '∇', r'\pm': '±', r'\mp': '∓',
+    r'\times': '×', r'\div': '÷', r'\cdot': '·', r'\circ': '∘',
+    r'\bullet': '•', r'\ldots': '…', r'\cdots': '⋯', r'\vdots': '⋮',
+    r'\ddots': '⋱', r'\leq': '≤', r'\geq': '≥', r'\neq': '≠',
+    r'\approx': '≈', r'\equiv': '≡', r'\sim': '∼', r'\simeq': '≃',
+    r'\propto': '∝', r'\infty': '∞', r'\in': '∈', r'\notin': '∉',
+    r'\subset': '⊂', r'\supset': '⊃', r'\subseteq': '⊆', r'\supseteq': '⊇',
+    r'\cup': '∪', r'\cap': '∩', r'\emptyset': '∅', r'\forall': '∀',
+    r'\exists': '∃', r'\neg': '¬', r'\land': '∧', r'\lor': '∨',
+    r'\rightarrow': '→', r'\leftarrow': '←', r'\leftrightarrow': '↔',
+    r'\Rightarrow': '⇒', r'\Leftarrow': '⇐', r'\Leftrightarrow': '⇔',
+    r'\uparrow': '↑', r'\downarrow': '↓', r'\updownarrow': '↕',
+    r'\angle': '∠', r'\perp': '⊥', r'\parallel': '∥',
+}
+
+# 全部符号合并成一个备选分支：一遍扫描替换完，而不是每个符号各扫一遍文本。
+# 按长度降序排列，保证 \subseteq 不会先被前缀 \subset 命中
+_MATH_SYMBOL_RE = re.compile('|'.join(
+    re.escape(k) for k in sorted(_MATH_SYMBOLS, key=len, reverse=True)))
+
+
+# 处理数学公式的函数
+def process_math_formulas(text):
+    """处理文本中的数学公式"""
+
+    # 首先保护代码块中的内容。占位符用 \x00 包裹数字：下标/上标正则会把
+    # "__CODE_BLOCK_0__" 这类带下划线的占位符自己改写掉，导致恢复失败丢代码，
+    # 而 \x00 不属于 \w，也不会出现在模型文本里，各替换遍次都碰不到它
+    code_blocks = []
+    def save_code_block(match):
+        code_blocks.append(match.group(0))
+        return f"\x00{len(code_blocks)-1}\x00"
+
+    # 保存代码块
+    text = _CODE_FENCE_RE.sub(save_code_block, text)
+    text = _INLINE_CODE_RE.sub(save_code_block, text)
+
+    # 处理块级公式
+    text = _MATH_BLOCK_RE.sub(lambda m: f'<div class="math-block">{m.group(1)}</div>', text)
+
+    # 处理行内公式
+    text = _INLINE_MATH_RE.sub(lambda m: f'<span class="math">{m.group(1)}</span>', text)
+
+    # 替换常见的数学符号：单次扫描，命中后查表取符号
+    text = _MATH_SYMBOL_RE.sub(lambda m: _MATH_SYMBOLS[m.group(0)], text)
+
+    # 处理上标和下标
+    text = _SUP_BRACE_RE.sub(r'<sup>\1</sup>', text)
+    text = _SUP_CHAR_RE.sub(r'<sup>\1</sup>', text)
+    text = _SUB_BRACE_RE.sub(r'<sub>\1</sub>', text)
+    text = _SUB_CHAR_RE.sub(r'<sub>\1</sub>', text)
+
+    # 恢复代码块
+    for i, code in enumerate(code_blocks):
+        text = text.replace(f"\x00{i}\x00", code)
+
+    return text
+
+# 修改markdown2的处理，为代码块添加包装器
+# 代码块 ID 用递增计数器：uuid4 每个代码块都要走一次 os.urandom，
+# 计数器既便宜又让输出可确定（配合上面的渲染缓存）
+_code_block_counter = itertools.count()
+
+def process_code_blocks(html_content):
+    """为代码块添加复制按钮"""
+
+    def wrap_code_block(match):
+        code_block = match.group(0)
+        code_id = f"code-{next(_code_block_counter)}"
+
+        # 提取代码内容
+        code_match = _CODE_WRAP_RE.search(code_block)
+        if code_match:
+            code_content = code_match.group(1)
+            # 创建包装器
+            wrapped = f'''<div class="code-block-wrapper">
+                <button class="copy-button" onclick="copyCode(this, '{code_id}')">
+                    复制
+                </button>
+                <pre><code id="{code_id}">{code_content}</code></pre>
+            </div>'''
+            return wrapped
+        return code_block
+
+    html_content = _CODE_WRAP_RE.sub(wrap_code_block, html_content)
+    return html_content
+
+
+# 单段文本的完整渲染管线（公式 -> Markdown -> 代码块包装）。
+# 历史消息不可变，按内容缓存后重复导出只需渲染新增的消息
+@lru_cache(maxsize=1024)
+def _render_text_part(text):
+    """渲染一段文本为导出页 HTML，结果按文本内容缓存"""
+    html = markdown2.markdown(
+        process_math_formulas(text),
+        extras=['fenced-code-blocks', 'tables', 'break-on-newline', 'code-friendly']
+    )
+    return process_code_blocks(html)
+
+# 导出时把大图缩成缩略图：满屏截图内联全尺寸 base64 会让导出页轻松到几十 MB，
+# 降到 1280px 的 JPEG 通常能把体积与浏览器解析时间压掉 5~10 倍。
+# 同样按内容缓存，重复导出同一批截图不重复缩放
+@lru_cache(maxsize=64)
+def _thumb_b64(mime, data_b64, max_dim=1280):
+    """导出用缩略图：大图降采样并重编码为 JPEG，小图原样返回 (mime, base64)"""
+    if len(data_b64) < 200_000:
+        return mime, data_b64
+    try:
+        img = Image.open(io.BytesIO(base64.b64decode(data_b64)))
+        img.draft('RGB', (max_dim, max_dim))
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, format='JPEG', quality=85)
+        return 'image/jpeg', base64.b64encode(buf.getvalue()).decode()
+    except Exception:
+        # 解码失败（损坏或非图片数据）时退回原始内容
+        return mime, data_b64
 
-    # 获取当前时间
-    now = datetime.now()
-    timestamp = now.strftime("%y%m%d_%H%M")
-    # 使用英文文件名避免编码问题
-    filename_display = f"{timestamp}对话历史.html"
-    # URL编码的文件名
-    filename_encoded = quote(filename_display.encode('utf-8'))
 
-    # 改进后的HTML模板，添加代码复制功能
-    html_template = """<!DOCTYPE html>
+# 导出页的 HTML 模板，拆成头/尾两段模块级常量：导出时按「头 -> 逐条消息 -> 尾」
+# 流式输出，峰值内存从整页 HTML 降到单条消息，浏览器也能更早开始解析。
+# 用 string.Template 预编译：占位符是 $ 风格，CSS/JS 里的花括号不用再双写转义，
+# 每次导出也不再让 str.format 整页扫描所有括号
+_EXPORT_HEAD_TMPL = string.Template("""<!DOCTYPE html>
 <html lang="zh-CN">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{title}</title>
+    <title>${title}</title>
 
     <style>
-        * {{
+        * {
             margin: 0;
             padding: 0;
             box-sizing: border-box;
-        }}
-        body {{
+        }
+        body {
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
             line-height: 1.6;
             color: #333;
             background-color: #f5f7fa;
             padding: 20px;
-        }}
-        .container {{
+        }
+        .container {
             max-width: 1400px;
             margin: 0 auto;
             background-color: white;
             border-radius: 10px;
             box-shadow: 0 2px 10px rgba(0,0,0,0.1);
             overflow: hidden;
-        }}
-        .header {{
+        }
+        .header {
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             color: white;
             padding: 30px;
             text-align: center;
-        }}
-        .header h1 {{
+        }
+        .header h1 {
             font-size: 28px;
             margin-bottom: 10px;
-        }}
-        .header .meta {{
+        }
+        .header .meta {
             font-size: 14px;
             opacity: 0.9;
-        }}
-        .conversation {{
+        }
+        .conversation {
             padding: 40px;
-        }}
-        .message {{
+        }
+        .message {
             margin-bottom: 30px;
             display: flex;
             flex-direction: column;
             align-items: flex-start;
-        }}
-        .message.user {{
+        }
+        .message.user {
             align-items: flex-end;
-        }}
+        }
 
         /* 角色标识样式 */
-        .message-header {{
+        .message-header {
             display: flex;
             align-items: center;
             margin-bottom: 8px;
             gap: 10px;
-        }}
-        .message.user .message-header {{
+        }
+        .message.user .message-header {
             flex-direction: row-reverse;
-        }}
-        .avatar {{
+        }
+        .avatar {
             width: 36px;
             height: 36px;
             border-radius: 50%;
@@ -354,21 +772,21 @@ def export_history():
             font-weight: bold;
             color: white;
             font-size: 16px;
-        }}
-        .message.user .avatar {{
+        }
+        .message.user .avatar {
             background-color: #0084ff;
-        }}
-        .message.bot .avatar {{
+        }
+        .message.bot .avatar {
             background-color: #7c3aed;
-        }}
-        .message-role {{
+        }
+        .message-role {
             font-size: 15px;
             font-weight: 600;
             color: #555;
-        }}
+        }
 
         /* 消息内容样式 */
-        .message-content {{
+        .message-content {
             max-width: 85%;
             width: 100%;
             padding: 16px 20px;
@@ -376,24 +794,24 @@ def export_history():
             position: relative;
             box-shadow: 0 1px 3px rgba(0,0,0,0.1);
             font-size: 15px;
-        }}
-        .message.user .message-content {{
+        }
+        .message.user .message-content {
             background-color: #e3f2fd;
             color: #1565c0;
             border: 1px solid #bbdefb;
-        }}
-        .message.bot .message-content {{
+        }
+        .message.bot .message-content {
             background-color: #f3f4f6;
             color: #1f2937;
             border: 1px solid #e5e7eb;
-        }}
+        }
 
         /* 代码块样式 */
-        .code-block-wrapper {{
+        .code-block-wrapper {
             position: relative;
             margin: 15px 0;
-        }}
-        .message-content pre {{
+        }
+        .message-content pre {
             background-color: #1e293b;
             color: #e2e8f0;
             padding: 15px;
@@ -402,10 +820,10 @@ def export_history():
             overflow-x: auto;
             font-size: 14px;
             margin: 0;
-        }}
+        }
 
         /* 复制按钮样式 */
-        .copy-button {{
+        .copy-button {
             position: absolute;
             top: 8px;
             right: 8px;
@@ -418,41 +836,41 @@ def export_history():
             cursor: pointer;
             transition: all 0.2s ease;
             font-family: inherit;
-        }}
-        .copy-button:hover {{
+        }
+        .copy-button:hover {
             background-color: #64748b;
             transform: translateY(-1px);
-        }}
-        .copy-button:active {{
+        }
+        .copy-button:active {
             transform: translateY(0);
-        }}
-        .copy-button.copied {{
+        }
+        .copy-button.copied {
             background-color: #10b981;
-        }}
+        }
 
         /* 行内代码样式 */
-        .message-content code {{
+        .message-content code {
             background-color: #e2e8f0;
             color: #0f172a;
             padding: 2px 6px;
             border-radius: 4px;
             font-family: 'Consolas', 'Monaco', 'Courier New', monospace;
             font-size: 0.9em;
-        }}
-        .message-content pre code {{
+        }
+        .message-content pre code {
             background-color: transparent;
             color: #e2e8f0;
             padding: 0;
-        }}
+        }
 
         /* 数学公式样式 */
-        .math {{
+        .math {
             font-family: 'Times New Roman', Times, serif;
             font-style: italic;
             margin: 0 0.25em;
             display: inline-block;
-        }}
-        .math-block {{
+        }
+        .math-block {
             display: block;
             text-align: center;
             margin: 1.2em 0;
@@ -460,157 +878,157 @@ def export_history():
             font-size: 1.15em;
             overflow-x: auto;
             padding: 0.5em 0;
-        }}
+        }
         /* 分数样式 */
-        .frac {{
+        .frac {
             display: inline-block;
             vertical-align: middle;
             text-align: center;
             position: relative;
             font-style: normal;
-        }}
-        .frac .num {{
+        }
+        .frac .num {
             display: block;
             border-bottom: 1px solid currentColor;
             padding-bottom: 0.1em;
-        }}
-        .frac .den {{
+        }
+        .frac .den {
             display: block;
             padding-top: 0.1em;
-        }}
+        }
         /* 上标和下标 */
-        .math sup, .math sub, .math-block sup, .math-block sub {{
+        .math sup, .math sub, .math-block sup, .math-block sub {
             font-size: 0.75em;
-        }}
-        .math sup {{
+        }
+        .math sup {
             vertical-align: super;
-        }}
-        .math sub {{
+        }
+        .math sub {
             vertical-align: sub;
-        }}
+        }
         /* 根号 */
-        .sqrt {{
+        .sqrt {
             position: relative;
             padding-left: 0.5em;
             padding-top: 0.1em;
             margin-left: 0.2em;
-        }}
-        .sqrt::before {{
+        }
+        .sqrt::before {
             content: '√';
             position: absolute;
             left: 0;
             top: 0;
             font-size: 1.2em;
-        }}
-        .sqrt.has-index::before {{
+        }
+        .sqrt.has-index::before {
             font-size: 1em;
-        }}
-        .sqrt-index {{
+        }
+        .sqrt-index {
             position: absolute;
             left: 0;
             top: -0.5em;
             font-size: 0.6em;
-        }}
+        }
 
         /* 内容格式化样式 */
-        .message-content img {{
+        .message-content img {
             max-width: 100%;
             height: auto;
             border-radius: 8px;
             margin-top: 10px;
             display: block;
             box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-        }}
-        .message-content p {{
+        }
+        .message-content p {
             margin-bottom: 12px;
             line-height: 1.7;
-        }}
-        .message-content p:last-child {{
+        }
+        .message-content p:last-child {
             margin-bottom: 0;
-        }}
-        .message-content ul, .message-content ol {{
+        }
+        .message-content ul, .message-content ol {
             margin: 12px 0;
             padding-left: 30px;
-        }}
-        .message-content li {{
+        }
+        .message-content li {
             margin-bottom: 6px;
-        }}
-        .message-content h1, .message-content h2, .message-content h3 {{
+        }
+        .message-content h1, .message-content h2, .message-content h3 {
             margin: 20px 0 12px 0;
             font-weight: 600;
-        }}
-        .message-content h1 {{
+        }
+        .message-content h1 {
             font-size: 24px;
-        }}
-        .message-content h2 {{
+        }
+        .message-content h2 {
             font-size: 20px;
-        }}
-        .message-content h3 {{
+        }
+        .message-content h3 {
             font-size: 18px;
-        }}
+        }
 
         /* 表格样式 */
-        .message-content table {{
+        .message-content table {
             border-collapse: collapse;
             width: 100%;
             margin: 15px 0;
-        }}
-        .message-content th, .message-content td {{
+        }
+        .message-content th, .message-content td {
             border: 1px solid #e5e7eb;
             padding: 8px 12px;
             text-align: left;
-        }}
-        .message-content th {{
+        }
+        .message-content th {
             background-color: #f9fafb;
             font-weight: 600;
-        }}
+        }
 
-        .footer {{
+        .footer {
             text-align: center;
             padding: 20px;
             color: #666;
             font-size: 14px;
             border-top: 1px solid #eee;
-        }}
+        }
 
         /* 响应式设计 */
-        @media (max-width: 768px) {{
-            .container {{
+        @media (max-width: 768px) {
+            .container {
                 margin: 0;
                 border-radius: 0;
-            }}
-            .header {{
+            }
+            .header {
                 padding: 20px;
-            }}
-            .header h1 {{
+            }
+            .header h1 {
                 font-size: 22px;
-            }}
-            .conversation {{
+            }
+            .conversation {
                 padding: 20px;
-            }}
-            .message-content {{
+            }
+            .message-content {
                 max-width: 100%;
                 font-size: 14px;
-            }}
-            .copy-button {{
+            }
+            .copy-button {
                 padding: 4px 8px;
                 font-size: 11px;
-            }}
-        }}
+            }
+        }
 
-        @media print {{
-            body {{
+        @media print {
+            body {
                 background: white;
                 padding: 0;
-            }}
-            .container {{
+            }
+            .container {
                 box-shadow: none;
                 max-width: 100%;
-            }}
-            .copy-button {{
+            }
+            .copy-button {
                 display: none !important;
-            }}
-        }}
+            }
+        }
     </style>
 </head>
 <body>
@@ -618,53 +1036,54 @@ def export_history():
         <div class="header">
             <h1>对话历史记录</h1>
             <div class="meta">
-                <div>导出时间：{export_time}</div>
+                <div>导出时间：${export_time}</div>
             </div>
         </div>
         <div class="conversation">
-            {messages}
-        </div>
+""")
+
+_EXPORT_FOOT_TMPL = string.Template("""        </div>
         <div class="footer">
-            <p>成功导出共 {message_count} 条消息</p>
+            <p>成功导出共 ${message_count} 条消息</p>
         </div>
     </div>
 
     <script>
         // 代码复制功能
-        function copyCode(button, codeId) {{
+        function copyCode(button, codeId) {
             const codeElement = document.getElementById(codeId);
-            if (!codeElement) {{
+            if (!codeElement) {
                 console.error('找不到代码元素:', codeId);
                 return;
-            }}
+            }
 
             // 获取代码文本，去除HTML标签
             const codeText = codeElement.textContent || codeElement.innerText;
 
             // 使用现代的Clipboard API（如果可用）
-            if (navigator.clipboard && navigator.clipboard.writeText) {{
-                navigator.clipboard.writeText(codeText).then(() => {{
+            if (navigator.clipboard && navigator.clipboard.writeText) {
+                navigator.clipboard.writeText(codeText).then(() => {
                     // 更新按钮状态
                     const originalText = button.textContent;
                     button.textContent = '已复制';
                     button.classList.add('copied');
 
-                    setTimeout(() => {{
+                    setTimeout(() => {
                         button.textContent = originalText;
                         button.classList.remove('copied');
-                    }}, 2000);
-                }}).catch(err => {{
+                    }, 2000);
+                }).catch(err => {
                     console.error('复制失败:', err);
                     fallbackCopy(codeText, button);
-                }});
-            }} else {{
+                });
+            } else {
                 // 降级方案
                 fallbackCopy(codeText, button);
-            }}
-        }}
+            }
+        }
 
         // 降级的复制方案
-        function fallbackCopy(text, button) {{
+        function fallbackCopy(text, button) {
             const textarea = document.createElement('textarea');
             textarea.value = text;
             textarea.style.position = 'fixed';
@@ -673,197 +1092,118 @@ def export_history():
             textarea.setAttribute('readonly', '');
             document.body.appendChild(textarea);
 
-            try {{
+            try {
                 textarea.select();
                 textarea.setSelectionRange(0, 99999); // 移动设备兼容
 
                 const successful = document.execCommand('copy');
-                if (successful) {{
+                if (successful) {
                     const originalText = button.textContent;
                     button.textContent = '已复制';
                     button.classList.add('copied');
 
-                    setTimeout(() => {{
+                    setTimeout(() => {
                         button.textContent = originalText;
                         button.classList.remove('copied');
-                    }}, 2000);
-                }} else {{
+                    }, 2000);
+                } else {
                     alert('复制失败，请手动选择并复制代码');
-                }}
-            }} catch (err) {{
+                }
+            } catch (err) {
                 console.error('复制失败:', err);
                 alert('复制失败，请手动选择并复制代码');
-            }} finally {{
+            } finally {
                 document.body.removeChild(textarea);
-            }}
-        }}
+            }
+        }
 
         // 简单的数学公式渲染器
-        function renderMath() {{
+        function renderMath() {
             // 处理块级公式
-            document.querySelectorAll('.math-block').forEach(function(elem) {{
+            document.querySelectorAll('.math-block').forEach(function(elem) {
                 let content = elem.innerHTML;
                 // 处理分数
-                content = content.replace(/\\\\\\\\frac{{([^}}]+)}}{{([^}}]+)}}/g, '<span class="frac"><span class="num">$1</span><span class="den">$2</span></span>');
+                content = content.replace(/\\\\\\\\frac{([^}]+)}{([^}]+)}/g, '<span class="frac"><span class="num">$1</span><span class="den">$2</span></span>');
                 // 处理平方根
-                content = content.replace(/\\\\\\\\sqrt{{([^}}]+)}}/g, '<span class="sqrt">$1</span>');
+                content = content.replace(/\\\\\\\\sqrt{([^}]+)}/g, '<span class="sqrt">$1</span>');
                 // 处理带指数的根号
-                content = content.replace(/\\\\\\\\sqrt\\[([^\\]]+)\\]{{([^}}]+)}}/g, '<span class="sqrt has-index"><span class="sqrt-index">$1</span>$2</span>');
+                content = content.replace(/\\\\\\\\sqrt\\[([^\\]]+)\\]{([^}]+)}/g, '<span class="sqrt has-index"><span class="sqrt-index">$1</span>$2</span>');
                 elem.innerHTML = content;
-            }});
+            });
 
             // 处理行内公式
-            document.querySelectorAll('.math').forEach(function(elem) {{
+            document.querySelectorAll('.math').forEach(function(elem) {
                 let content = elem.innerHTML;
                 // 处理分数
-                content = content.replace(/\\\\\\\\frac{{([^}}]+)}}{{([^}}]+)}}/g, '<span class="frac"><span class="num">$1</span><span class="den">$2</span></span>');
+                content = content.replace(/\\\\\\\\frac{([^}]+)}{([^}]+)}/g, '<span class="frac"><span class="num">$1</span><span class="den">$2</span></span>');
                 // 处理平方根
-                content = content.replace(/\\\\\\\\sqrt{{([^}}]+)}}/g, '<span class="sqrt">$1</span>');
+                content = content.replace(/\\\\\\\\sqrt{([^}]+)}/g, '<span class="sqrt">$1</span>');
                 elem.innerHTML = content;
-            }});
-        }}
+            });
+        }
 
         // 页面加载完成后执行
         document.addEventListener('DOMContentLoaded', renderMath);
     </script>
 </body>
-</html>"""
-
-    # 处理数学公式的函数
-    def process_math_formulas(text):
-        """处理文本中的数学公式"""
-
-        # 首先保护代码块中的内容
-        code_blocks = []
-        def save_code_block(match):
-            code_blocks.append(match.group(0))
-            return f"__CODE_BLOCK_{len(code_blocks)-1}__"
-
-        # 保存代码块
-        text = re.sub(r'```[\\s\\S]*?```', save_code_block, text)
-        text = re.sub(r'`[^`]+`', save_code_block, text)
-
-        # 处理块级公式
-        text = re.sub(r'\\$\\$(.*?)\\$\\$', lambda m: f'<div class="math-block">{m.group(1)}</div>', text, flags=re.DOTALL)
-
-        # 处理行内公式
-        text = re.sub(r'\\$([^\\$]+)\\$', lambda m: f'<span class="math">{m.group(1)}</span>', text)
-
-        # 替换常见的数学符号
-        math_symbols = {
-            r'\\\\alpha': 'α', r'\\\\beta': 'β', r'\\\\gamma': 'γ', r'\\\\delta': 'δ',
-            r'\\\\epsilon': 'ε', r'\\\\zeta': 'ζ', r'\\\\eta': 'η', r'\\\\theta': 'θ',
-            r'\\\\iota': 'ι', r'\\\\kappa': 'κ', r'\\\\lambda': 'λ', r'\\\\mu': 'μ',
-            r'\\\\nu': 'ν', r'\\\\xi': 'ξ', r'\\\\pi': 'π', r'\\\\rho': 'ρ',
-            r'\\\\sigma': 'σ', r'\\\\tau': 'τ', r'\\\\upsilon': 'υ', r'\\\\phi': 'φ',
-            r'\\\\chi': 'χ', r'\\\\psi': 'ψ', r'\\\\omega': 'ω',
-            r'\\\\Alpha': 'Α', r'\\\\Beta': 'Β', r'\\\\Gamma': 'Γ', r'\\\\Delta': 'Δ',
-            r'\\\\Epsilon': 'Ε', r'\\\\Zeta': 'Ζ', r'\\\\Eta': 'Η', r'\\\\Theta': 'Θ',
-            r'\\\\Iota': 'Ι', r'\\\\Kappa': 'Κ', r'\\\\Lambda': 'Λ', r'\\\\Mu': 'Μ',
-            r'\\\\Nu': 'Ν', r'\\\\Xi': 'Ξ', r'\\\\Pi': 'Π', r'\\\\Rho': 'Ρ',
-            r'\\\\Sigma': 'Σ', r'\\\\Tau': 'Τ', r'\\\\Upsilon': 'Υ', r'\\\\Phi': 'Φ',
-            r'\\\\Chi': 'Χ', r'\\\\Psi': 'Ψ', r'\\\\Omega': 'Ω',
-            r'\\\\sum': '∑', r'\\\\prod': '∏', r'\\\\int': '∫', r'\\\\oint': '∮',
-            r'\\\\partial': '∂', r'\\\\nabla': '∇', r'\\\\pm': '±', r'\\\\mp': '∓',
-            r'\\\\times': '×', r'\\\\div': '÷', r'\\\\cdot': '·', r'\\\\circ': '∘',
-            r'\\\\bullet': '•', r'\\\\ldots': '…', r'\\\\cdots': '⋯', r'\\\\vdots': '⋮',
-            r'\\\\ddots': '⋱', r'\\\\leq': '≤', r'\\\\geq': '≥', r'\\\\neq': '≠',
-            r'\\\\approx': '≈', r'\\\\equiv': '≡', r'\\\\sim': '∼', r'\\\\simeq': '≃',
-            r'\\\\propto': '∝', r'\\\\infty': '∞', r'\\\\in': '∈', r'\\\\notin': '∉',
-            r'\\\\subset': '⊂', r'\\\\supset': '⊃', r'\\\\subseteq': '⊆', r'\\\\supseteq': '⊇',
-            r'\\\\cup': '∪', r'\\\\cap': '∩', r'\\\\emptyset': '∅', r'\\\\forall': '∀',
-            r'\\\\exists': '∃', r'\\\\neg': '¬', r'\\\\land': '∧', r'\\\\lor': '∨',
-            r'\\\\rightarrow': '→', r'\\\\leftarrow': '←', r'\\\\leftrightarrow': '↔',
-            r'\\\\Rightarrow': '⇒', r'\\\\Leftarrow': '⇐', r'\\\\Leftrightarrow': '⇔',
-            r'\\\\uparrow': '↑', r'\\\\downarrow': '↓', r'\\\\updownarrow': '↕',
-            r'\\\\angle': '∠', r'\\\\perp': '⊥', r'\\\\parallel': '∥',
-        }
+</html>""")
 
-        for pattern, symbol in math_symbols.items():
-            text = text.replace(pattern, symbol)
-
-        # 处理上标和下标
-        text = re.sub(r'\\^{{([^}}]+)}}', r'<sup>\\1</sup>', text)
-        text = re.sub(r'\\^(\\w)', r'<sup>\\1</sup>', text)
-        text = re.sub(r'_{{([^}}]+)}}', r'<sub>\\1</sub>', text)
-        text = re.sub(r'_(\\w)', r'<sub>\\1</sub>', text)
-
-        # 恢复代码块
-        for i, code in enumerate(code_blocks):
-            text = text.replace(f"__CODE_BLOCK_{i}__", code)
-
-        return text
-
-    # 修改markdown2的处理，为代码块添加包装器
-    def process_code_blocks(html_content):
-        """为代码块添加复制按钮"""
-        import uuid
-
-        def wrap_code_block(match):
-            code_block = match.group(0)
-            code_id = f"code-{uuid.uuid4().hex[:8]}"
-
-            # 提取代码内容
-            code_match = re.search(r'<pre><code[^>]*?>(.*?)</code></pre>', code_block, re.DOTALL)
-            if code_match:
-                code_content = code_match.group(1)
-                # 创建包装器
-                wrapped = f'''<div class="code-block-wrapper">
-                    <button class="copy-button" onclick="copyCode(this, '{code_id}')">
-                        复制
-                    </button>
-                    <pre><code id="{code_id}">{code_content}</code></pre>
-                </div>'''
-                return wrapped
-            return code_block
-
-        html_content = re.sub(r'<pre><code>.? < / code > < / pre > ', wrap_code_block, html_content, flags=re.DOTALL)
-        return html_content
-
-    # 构建消息HTML（合并相邻文本 part）
-    messages_html = []
-    message_count = 0
-
-    for msg in chat_history:
-        message_count += 1
-        role = msg.get('role', 'model')
-        role_display = '用户' if role == 'user' else 'AI助手'
-        message_class = 'user' if role == 'user' else 'bot'
-        avatar_text = '我' if role == 'user' else 'AI'
-
-        content_parts = []
-        text_buffer = []
 
-        def flush_text():
-            nonlocal content_parts, text_buffer
-            if text_buffer:
-                merged = ''.join(text_buffer)  # 不人为加换行，保持句子连贯
-                # 先处理数学公式
-                text_with_math = process_math_formulas(merged)
-                # 转换Markdown到HTML
-                text_html = markdown2.markdown(
-                    text_with_math,
-                    extras=['fenced-code-blocks', 'tables', 'break-on-newline', 'code-friendly']
-                )
-                # 为代码块添加复制按钮
-                text_html = process_code_blocks(text_html)
-                content_parts.append(text_html)
-                text_buffer = []
+@app.route('/export', methods=['GET'])
+def export_history():
+    """
+    导出对话历史为HTML格式
+    """
+    # 获取当前时间
+    now = datetime.now()
+    timestamp = now.strftime("%y%m%d_%H%M")
+    # 使用英文文件名避免编码问题
+    filename_display = f"{timestamp}对话历史.html"
+    # URL编码的文件名
+    filename_encoded = quote(filename_display.encode('utf-8'))
 
-        for part in msg.get('parts', []):
-            if 'text' in part:
-                text_buffer.append(part['text'])
-            elif 'inline_data' in part:
-                # 先冲刷已有文本，再插入图片
-                flush_text()
-                img_html = f'<img src="data:{part["inline_data"]["mime_type"]};base64,{part["inline_data"]["data"]}" alt="图片">'
-                content_parts.append(img_html)
+    # 流式生成：头部 -> 逐条消息 -> 尾部，整页 HTML 不再在内存中物化，
+    # 峰值内存只有单条消息大小，浏览器也能边收边解析
+    snapshot = _history_snapshot
+
+    def generate():
+        yield _EXPORT_HEAD_TMPL.safe_substitute(
+            title=now.strftime("%Y年%m月%d日 %H:%M") + " 对话历史",
+            export_time=now.strftime("%Y年%m月%d日 %H:%M:%S")
+        )
+
+        for msg in snapshot:
+            role = msg.get('role', 'model')
+            role_display = '用户' if role == 'user' else 'AI助手'
+            message_class = 'user' if role == 'user' else 'bot'
+            avatar_text = '我' if role == 'user' else 'AI'
 
-        # 处理残留文本
-        flush_text()
+            content_parts = []
+            text_buffer = []
+
+            def flush_text():
+                nonlocal content_parts, text_buffer
+                if text_buffer:
+                    merged = ''.join(text_buffer)  # 不人为加换行，保持句子连贯
+                    content_parts.append(_render_text_part(merged))
+                    text_buffer = []
+
+            for part in msg.get('parts', []):
+                if 'text' in part:
+                    text_buffer.append(part['text'])
+                elif 'inline_data' in part:
+                    # 先冲刷已有文本，再插入图片
+                    flush_text()
+                    mime, data = _thumb_b64(
+                        part['inline_data'].get('mime_type', 'image/png'),
+                        _image_data(part))
+                    content_parts.append(f'<img src="data:{mime};base64,{data}" alt="图片">')
+
+            # 处理残留文本
+            flush_text()
 
-        # 单条消息 HTML
-        message_html = f'''
+            # 单条消息 HTML
+            yield f'''
         <div class="message {message_class}">
             <div class="message-header">
                 <div class="avatar">{avatar_text}</div>
@@ -874,52 +1214,90 @@ def export_history():
             </div>
         </div>
         '''
-        messages_html.append(message_html)
-
-    # 填充模板
-    html_content = html_template.format(
-        title=now.strftime("%Y年%m月%d日 %H:%M") + " 对话历史",
-        export_time=now.strftime("%Y年%m月%d日 %H:%M:%S"),
-        messages=''.join(messages_html),
-        message_count=message_count
-    )
 
-    timestamp = now.strftime("%y%m%d_%H%M")
+        yield _EXPORT_FOOT_TMPL.safe_substitute(message_count=len(snapshot))
+
     filename = f"chat_history_{timestamp}.html"
 
-    # 创建响应，使用URL编码的文件名
-    response = Response(
-        html_content,
+    # 创建响应：分块传输，边渲染边下发
+    return Response(
+        stream_with_context(generate()),
         mimetype='text/html',
         headers={
             'Content-Disposition': f'attachment; filename="{filename}"',
             'Content-Type': 'text/html; charset=utf-8'
         }
     )
-    return response
 
 
 # ----------------- 图片压缩（> 18.5 MB 自动压） -----------------
-def maybe_compress_image(b64, target_kb=189400):
-    raw = base64.b64decode(b64)
-    if len(raw) <= target_kb * 1024:
+_COMPRESS_TARGET_KB = 189400
+# 阈值对应的 base64 字符串长度上限：调用方可据此直接跳过压缩
+_COMPRESS_B64_LIMIT = _COMPRESS_TARGET_KB * 1024 * 4 // 3
+
+# 压缩结果缓存：同一张图反复发送（截图后连问几轮）时跳过整个重编码循环。
+# blake2b 吞吐远高于 JPEG 编码，哈希一次的成本可忽略；条目数封顶防止内存膨胀
+_compress_cache = {}
+_COMPRESS_CACHE_MAX = 32
+
+def maybe_compress_image(b64, target_kb=_COMPRESS_TARGET_KB):
+    target_bytes = target_kb * 1024
+    # 用 base64 长度估算解码后大小（误差不超过填充的2字节），
+    # 小图（常见情况）完全不解码
+    approx = (len(b64) * 3 >> 2) - b64.count('=', len(b64) - 2)
+    if approx <= target_bytes:
         return b64
 
+    cache_key = hashlib.blake2b(b64.encode(), digest_size=16).digest()
+    cached = _compress_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    raw = base64.b64decode(b64)
     img = Image.open(io.BytesIO(raw))
-    quality = 90
+    # 已是JPEG且只略超阈值：重编码收益有限，直接透传
+    if img.format == 'JPEG' and len(raw) <= target_bytes * 1.1:
+        return _cache_compressed(cache_key, b64)
+
+    # 长边超过 2048 先降采样：多模态输入更高的分辨率没有增益，
+    # 而 JPEG 编码成本与像素数成正比，4倍线性缩小即16倍编码量减少。
+    # JPEG 源先用 draft 让解码器直接按约 1/2、1/4 尺度做 IDCT，省掉全尺寸解码
+    img.draft('RGB', (2048, 2048))
+    img.thumbnail((2048, 2048), Image.LANCZOS)
+
+    # 按目标比例估算起始质量，配合 optimize + 渐进式 + 4:2:0 色度抽样，
+    # 通常 1~2 次编码即可收敛，不再从 90 开始线性扫描
+    ratio = target_bytes / len(raw)
+    quality = max(35, min(90, int(90 * ratio ** 0.5)))
+    buff = io.BytesIO()
     while True:
-        buff = io.BytesIO()
-        img.save(buff, format='JPEG', quality=quality)
-        if buff.tell() / 1024 <= target_kb or quality < 35:
-            return base64.b64encode(buff.getvalue()).decode()
-        quality -= 5
+        # 复用同一个缓冲，多次尝试时不再反复分配MB级对象
+        buff.seek(0)
+        buff.truncate()
+        img.save(buff, format='JPEG', quality=quality,
+                 optimize=True, progressive=True, subsampling=2)
+        if buff.tell() <= target_bytes or quality < 35:
+            # getbuffer 直接暴露 BytesIO 内部存储，免去 getvalue 的整块拷贝
+            return _cache_compressed(
+                cache_key, base64.b64encode(buff.getbuffer()).decode())
+        quality -= 10
+
+def _cache_compressed(cache_key, result):
+    """写入压缩缓存并返回结果，超出上限时淘汰最旧条目"""
+    if len(_compress_cache) >= _COMPRESS_CACHE_MAX:
+        _compress_cache.pop(next(iter(_compress_cache)))
+    _compress_cache[cache_key] = result
+    return result
 
 # ----------------- 截图（最小化浏览器 + 框选区域） -----------------
 def grab_screen_interactive():
-    try:
-        import pygetwindow as gw
-        win = gw.getActiveWindow();  win.minimize()
-    except Exception:  win = None
+    win = None
+    if gw is not None:
+        try:
+            win = gw.getActiveWindow()
+            win.minimize()
+        except Exception:
+            win = None
     start = {}; bbox = {}
     root = tk.Tk()
     root.attributes('-fullscreen', True)
@@ -956,15 +1334,29 @@ def grab_screen_interactive():
     except Exception:
         pass
     if 'val' not in bbox:
-        return None
+        return None, None
     x1,y1,x2,y2 = bbox['val']
     w,h = x2-x1, y2-y1
     if w<5 or h<5:
-        return None
-    img = pyautogui.screenshot(region=(x1, y1, w, h))
+        return None, None
+    if mss is not None:
+        # mss 返回原始像素缓冲，frombuffer 零拷贝包装成 PIL 图像
+        with mss.mss() as sct:
+            shot = sct.grab({'left': x1, 'top': y1, 'width': w, 'height': h})
+            img = Image.frombuffer('RGB', shot.size, shot.rgb, 'raw', 'RGB', 0, 1)
+    else:
+        img = pyautogui.screenshot(region=(x1, y1, w, h))
     buf = io.BytesIO()
-    img.save(buf, format='PNG')
-    return base64.b64encode(buf.getvalue()).decode()
+    # 大区域直接编码 JPEG：跳过沉重的 PNG deflate 和下游的解码重编码；
+    # 小区域保留 PNG（文字截图无损更清晰），压缩级别降到6换取编码速度
+    if w * h > 1_000_000:
+        img.convert('RGB').save(buf, format='JPEG', quality=88,
+                                optimize=True, progressive=True, subsampling=2)
+        mime = 'image/jpeg'
+    else:
+        img.save(buf, format='PNG', optimize=True, compress_level=6)
+        mime = 'image/png'
+    return buf.getvalue(), mime
 
 # ----------------- Flask 路由 -----------------
 @app.route('/')
@@ -977,64 +1369,9 @@ def index():
 def history():
     """
     给前端读取完整历史 → 前端自己渲染 markdown
-    使用“合并相邻文本 part”的策略，避免一句话被拆成多行
+    渲染在消息追加时已完成（_render_preview），这里只剩序列化预渲染快照
     """
-    global chat_history
-    md_list = []
-
-    # 拷贝一份以防遍历时外部修改
-    temp_history = list(chat_history)
-
-    for msg in temp_history:
-        role = msg.get('role')
-        if role == 'user':
-            md = ''
-            for part in msg.get('parts', []):
-                if 'text' in part:
-                    md += part['text'] + '\n'  # 用户输入按原逻辑，允许多行
-                if 'inline_data' in part:
-                    md += '<br><br>![alt text](data:%s;base64,%s)\n' % (
-                        part['inline_data'].get('mime_type', 'image/png'),
-                        (part['inline_data'].get('data', '')[:30] + '...')
-                    )
-            md_list.append({'who': 'user', 'md': md})
-
-        elif role == 'model':
-            parts = msg.get('parts', [])
-            if not parts:
-                md_list.append({'who': 'bot', 'md': '[空回复或格式错误]'})
-                continue
-
-            md = ''
-            text_buffer = []
-
-            def flush_md_text():
-                nonlocal md, text_buffer
-                if text_buffer:
-                    # 不额外添加换行，直接拼接，保持一句话连续
-                    md += ''.join(text_buffer)
-                    text_buffer = []
-
-            for part in parts:
-                if 'text' in part and part['text']:
-                    text_buffer.append(part['text'])
-                elif 'inline_data' in part:
-                    # 先把已有文本 flush，再插入图片占位
-                    flush_md_text()
-                    mime = part['inline_data'].get('mime_type', 'image/png')
-                    data_b64 = part['inline_data'].get('data', '')
-                    if data_b64:
-                        md += f'\n![ai image](data:{mime};base64,{data_b64[:30]}...)\n'
-
-            flush_md_text()
-            if not md.strip():
-                md = '[空回复]'
-            md_list.append({'who': 'bot', 'md': md})
-
-        else:
-            # 未知角色兜底
-            md_list.append({'who': 'bot', 'md': '[未知消息类型]'})
-    return jsonify(md_list)
+    return jsonify(list(_preview_snapshot))
 
 
 @app.route('/chat', methods=['POST'])
@@ -1043,52 +1380,52 @@ def chat_initiate():
     修改后的 /chat 接口: 只接收用户消息，存入历史，不调用 LLM。
     !! 在 chat_history 为空时，自动添加 BASE_PROMPT 到第一条用户消息中 !!
     """
-    global chat_history, chat_history_lock # 确保可以修改全局变量
-    with chat_history_lock:
-        data = request.get_json(force=True)
-        text  = (data.get('text') or '').strip()
-        img_b64 = data.get('image')
-        suppress_base_prompt = bool(data.get('suppress_base_prompt'))  # 新增
-
-        if not text and not img_b64:
-            # 如果用户既没有输入文本也没有上传图片，则不允许发送
-            # （即使是第一条消息，也需要用户触发，不能仅靠 BASE_PROMPT 发起）
-            return jsonify({'error': '请输入内容或添加图片/截图'}), 400
-
-        # -------- 组装 user 消息 --------
-        parts = []
-
-        # !! 核心改动：检查 chat_history 是否为空 !!仅当未抑制且 BASE_PROMPT 非空时注入
-        is_first_message = not chat_history
-        if is_first_message and BASE_PROMPT and not suppress_base_prompt:
-            # 如果是第一条消息，并且 BASE_PROMPT 非空，则将其作为第一个 part 添加
-            parts.append({'text': BASE_PROMPT})
-
-        # 添加用户实际输入的文本 (如果存在)
-        if text:
-            parts.append({'text': text})
-
-        # 添加用户实际上传的图片 (如果存在)
-        if img_b64:
-            mime = 'image/png' # 假设截图和上传都是 png 或会被转为 png/jpeg
-            try:
-                # 尝试压缩图片，如果失败则记录错误但可能继续（取决于你的需求）
+    # 解析、校验、压缩全部在锁外完成：JPEG 重编码可达上百毫秒，
+    # 不应让其它 /chat、/reset、/stream 请求陪着等
+    data = request.get_json(force=True)
+    text  = (data.get('text') or '').strip()
+    img_b64 = data.get('image')
+    suppress_base_prompt = bool(data.get('suppress_base_prompt'))  # 新增
+
+    if not text and not img_b64:
+        # 如果用户既没有输入文本也没有上传图片，则不允许发送
+        # （即使是第一条消息，也需要用户触发，不能仅靠 BASE_PROMPT 发起）
+        return jsonify({'error': '请输入内容或添加图片/截图'}), 400
+
+    # -------- 组装 user 消息 --------
+    parts = []
+
+    # 添加用户实际输入的文本 (如果存在)
+    if text:
+        parts.append({'text': text})
+
+    # 添加用户实际上传的图片 (如果存在)
+    if img_b64:
+        try:
+            # 尝试压缩图片，如果失败则记录错误但可能继续（取决于你的需求）；
+            # 低于阈值的小图（常见情况）连压缩器都不进
+            if len(img_b64) > _COMPRESS_B64_LIMIT:
                 img_b64 = maybe_compress_image(img_b64)
-                parts.append({'inline_data': {'mime_type': mime, 'data': img_b64}})
-            except Exception as e:
-                print(f"Error compressing image: {e}")
-                pass
-        # 再次检查 parts 是否为空 (理论上，如果 text 或 img_b64 至少有一个，就不会为空)
-        # 但如果 BASE_PROMPT 是唯一内容且用户未输入，前面的检查会阻止
-        if not parts:
-             print("Warning: Attempting to send an empty message after processing.")
-             return jsonify({'error': '处理后内容为空'}), 400
-
-        # 构造最终的用户消息
-        user_msg = {'role': 'user', 'parts': parts}
-        # 将构造好的用户消息添加到历史记录中
-        chat_history.append(user_msg)
-        return jsonify({'ok': True})
+            # 压缩可能把 PNG 转成 JPEG，所以在压缩后再识别格式
+            # （JPEG 的 base64 以 /9j/ 开头，PNG 以 iVBOR 开头）
+            mime = 'image/jpeg' if img_b64.startswith('/9j/') else 'image/png'
+            parts.append(_store_image(mime, img_b64))
+        except Exception as e:
+            print(f"Error compressing image: {e}")
+            pass
+    # 再次检查 parts 是否为空 (理论上，如果 text 或 img_b64 至少有一个，就不会为空)
+    # 但如果 BASE_PROMPT 是唯一内容且用户未输入，前面的检查会阻止
+    if not parts:
+         print("Warning: Attempting to send an empty message after processing.")
+         return jsonify({'error': '处理后内容为空'}), 400
+
+    # 临界区只剩首条消息判断与一次追加
+    with chat_history_lock:
+        # 仅当未抑制且 BASE_PROMPT 非空时注入到第一条用户消息
+        if not chat_history and BASE_PROMPT and not suppress_base_prompt:
+            parts.insert(0, {'text': BASE_PROMPT})
+        _append_history({'role': 'user', 'parts': parts})
+    return jsonify({'ok': True})
 
 
 @app.route('/stream')
@@ -1102,27 +1439,39 @@ def stream():
     enable_search = enable_search_str == 'true'
     tools = [{"google_search": {}}] if enable_search else None
 
-    # 检查 chat_history 是否为空或最后一个不是 user 消息 (理论上不应发生)
-    if not chat_history or chat_history[-1]['role'] != 'user':
+    # 无锁取只读快照；检查是否为空或最后一个不是 user 消息 (理论上不应发生)
+    history = _history_snapshot
+    if not history or history[-1]['role'] != 'user':
         def error_stream():
-            yield f"event: error\ndata: {json.dumps({'text': '错误：无法开始流，聊天历史状态异常。'})}\n\n"
-            yield f"event: end\ndata: [DONE]\n\n"
-        return Response(error_stream(), mimetype='text/event-stream')
+            yield 'event: error\n' + _sse_text_frame('错误：无法开始流，聊天历史状态异常。')
+            yield _SSE_END
+        return Response(error_stream(), mimetype='text/event-stream',
+                        headers=_SSE_HEADERS)
 
-    # 使用流式生成器函数作为响应体
-    # 传递当前的 chat_history 副本，避免在生成过程中被外部修改影响
-    return Response(stream_gemini_response(list(chat_history), model, tools), mimetype='text/event-stream')
+    # 使用流式生成器函数作为响应体（stream_with_context 保住请求上下文直到生成器收尾）
+    # 快照本身不可变，无需再拷贝一份
+    return Response(stream_with_context(stream_gemini_response(history, model, tools)),
+                    mimetype='text/event-stream', headers=_SSE_HEADERS)
 
 
 @app.route('/screenshot', methods=['POST'])
 def screenshot():
-    # ... (代码不变) ...
-    img_b64 = grab_screen_interactive()
-    if img_b64:
-        return jsonify({'img': img_b64})
-    return jsonify({'img': None}), 500
+    raw, mime = grab_screen_interactive()
+    if raw is None:
+        # 用户取消或选区过小
+        return Response(status=204)
+    # 直接回传原始图片字节：比 base64-in-JSON 少 1/3 流量，
+    # 服务端免去 base64 编码，客户端免去 JSON 解析
+    return Response(raw, mimetype=mime)
 
 # ----------------- 主入口 -----------------
 if __name__ == '__main__':
-    # threaded=True 对于 SSE 是必要的
-    app.run(debug=True, threaded=True, port=PORT, host='127.0.0.1')
\ No newline at end of file
+    try:
+        # 优先使用生产级 WSGI 服务器：没有调试器/重载器开销，
+        # 线程池长连接处理对多路 SSE 友好；未安装时退回开发服务器
+        from waitress import serve
+        print(f"使用 waitress 服务于 127.0.0.1:{PORT}")
+        serve(app, host='127.0.0.1', port=PORT, threads=32, channel_timeout=600)
+    except ImportError:
+        # threaded=True 对于 SSE 是必要的
+        app.run(debug=True, threaded=True, port=PORT, host='127.0.0.1')
\ No newline at end of file
@@ -1,9 +1,16 @@
 # config.py
+import functools
 import yaml
 import pathlib
 import logging
 from api_key_manager import APIKeyManager, NoAvailableKeysError
 
+# 优先使用 libyaml 的 C 实现解析器，未编译 C 扩展时退回纯 Python 实现
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 # ================== 日志配置 ==================
 logging.basicConfig(
     level=logging.INFO,
@@ -17,18 +24,25 @@ KEY_PATH = BASE_DIR / "key.txt"
 DB_PATH = BASE_DIR / "api_keys.db"  # 统一的SQLite数据库
 
 # ================== 配置加载 ==================
+@functools.lru_cache(maxsize=8)
+def _load_yaml_cached(path_str, mtime_ns):
+    """按 (路径, mtime_ns) 缓存解析结果，文件未变化时跳过重复解析"""
+    with open(path_str, 'r', encoding='utf-8') as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
 def load_yaml(path=CFG_PATH):
     """加载YAML配置文件"""
-    if not path.exists():
-        raise FileNotFoundError(f"缺少配置文件 {path}")
-    with open(path, 'r', encoding='utf-8') as f:
-        return yaml.safe_load(f)
-
-# 加载配置
-_yaml = load_yaml()
+    path = pathlib.Path(path)
+    # 直接 stat，文件不存在时由异常兜底，避免 exists+open 之间的竞态和多余的一次系统调用
+    try:
+        mtime_ns = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(f"缺少配置文件 {path}") from None
+    return _load_yaml_cached(str(path), mtime_ns)
 
 # ================== 初始化 APIKeyManager ==================
 try:
+    _yaml = load_yaml()
     api_key_config = {
         'cooldown_seconds': _yaml.get('cooldown_seconds', 300),
         'requests_per_minute': _yaml.get('requests_per_minute', 5),
@@ -54,12 +68,26 @@ except Exception as e:
     logging.critical(f"初始化时发生未知错误: {e}", exc_info=True)
     exit(1)
 
-# ================== 导出配置项 ==================
-MODEL_BASE_URL = _yaml.get("base_url", "")
-THRESHOLD_KB = int(_yaml.get("threshold_kb", 3600))
-PORT = int(_yaml.get("port", 5000))
-BASE_PROMPT = _yaml.get("base_prompt", "")
-MODELS = _yaml.get("models", [])
+# ================== 导出配置项（按需加载） ==================
+# 属性名 -> (YAML 键, 默认值, 是否转 int)
+_LAZY_CONFIG = {
+    'MODEL_BASE_URL': ('base_url', '', False),
+    'THRESHOLD_KB': ('threshold_kb', 3600, True),
+    'PORT': ('port', 5000, True),
+    'BASE_PROMPT': ('base_prompt', '', False),
+    'MODELS': ('models', [], False),
+}
+
+def __getattr__(name):
+    """PEP 562：配置常量首次访问时才从 YAML 取值，并缓存到模块全局供后续直接查找"""
+    if name in _LAZY_CONFIG:
+        yaml_key, default, as_int = _LAZY_CONFIG[name]
+        value = load_yaml().get(yaml_key, default)
+        if as_int:
+            value = int(value)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ================== 导出实用函数 ==================
 def get_api_key(preferred_key=None):